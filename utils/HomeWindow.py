@@ -5,18 +5,13 @@ Created on Wed Dec 13 15:06:21 2023
 
 @author: mitchell
 """
-import SimpleITK as sitk
 import webbrowser
-from .ImageLabel import ImageLabel
+from .ImageLabel import ImageLabel, load_thumbnail
 from tkinter import *
 from tkinter import filedialog
-from utils.mesh_manipulationv2 import MeshManipulationWindow 
-import pyvista as pv
 import sys
-from PyQt5 import QtWidgets
-from .sitk2vtk import *
-from .vtkutils import *
-from utils.ROIDataAquisition import ROIDataAquisition
+# SimpleITK, pyvista, Qt and the later steps are imported where they are
+# first needed so the intro window comes up without waiting on them
   
 
 class HomeWindow(object):
@@ -49,8 +44,7 @@ class HomeWindow(object):
                             self.registration_frame, self.final_frame]
         
         # Add logo image
-        self.logo = PhotoImage(file='images/logo3.png')
-        self.logo = self.logo.subsample(7,7)
+        self.logo = load_thumbnail('images/logo3.png', 7, master=self.root)
         self.logo_label = Label(master=self.intro_frame, image = self.logo)
         self.logo_label.image = self.logo
         self.logo_label.grid(column = 1, row = 0, rowspan=2)
@@ -107,11 +101,7 @@ class HomeWindow(object):
         
         # ROI button launches ROI class, unpacks the home frame, and resizes window
         self.ROI_button = Button(master = self.intro_frame, state=DISABLED, 
-                            command = lambda:[self.intro_frame.pack_forget(), 
-                                              ROIDataAquisition(self.moving_image, 
-                                                                self.ROI_frame, 
-                                                                self.root, 
-                                                                self.frames_list)], 
+                            command = self.run_roi_selection, 
                                 text = 'Next: ROI Selection')
             
         self.ROI_button.grid(column=1, row=1, sticky='e')
@@ -120,9 +110,21 @@ class HomeWindow(object):
         # Start the Tkinter main loop
         mainloop()
     
+    def run_roi_selection(self):
+        from utils.ROIDataAquisition import ROIDataAquisition
+        
+        self.intro_frame.pack_forget()
+        # hand the image over so only the ROI step keeps the full volume alive
+        moving_image = self.moving_image
+        del self.moving_image
+        ROIDataAquisition(moving_image, self.ROI_frame, 
+                          self.root, self.frames_list)
+    
     # file explorer window
     def browseFiles(self, filetype = '.nii'):
         if filetype == '.nii':
+            import SimpleITK as sitk
+            
             FILENAME = filedialog.askopenfilename(initialdir = './nifti_files/Example',
                                                   filetypes=[
                             ("image", ".dcm"),
@@ -131,7 +133,14 @@ class HomeWindow(object):
                         ])
             print('loaded file:', FILENAME)
             self.filevar.set(FILENAME)
-            self.moving_image = sitk.DICOMOrient(sitk.ReadImage(FILENAME), 'LPS')
+            image = sitk.ReadImage(FILENAME)
+            # DICOMOrient resamples into a new buffer even when there is
+            # nothing to do, so only call it if the image isn't LPS already
+            orientation = sitk.DICOMOrientImageFilter.GetOrientationFromDirectionCosines(
+                image.GetDirection())
+            if orientation != 'LPS':
+                image = sitk.DICOMOrient(image, 'LPS')
+            self.moving_image = image
         
         elif filetype == '.stl':
             self.stl_file = filedialog.askopenfilename(initialdir = './head_stls/',
@@ -142,12 +151,16 @@ class HomeWindow(object):
 
     # var, index, and mode parameters need to be fed because of the stringvar trace        
     def run_mesh_manipulation_window(self, var, index, mode):
+        import pyvista as pv
+        from PyQt5 import QtWidgets
+        from utils.mesh_manipulationv2 import MeshManipulationWindow, load_template
+        
         #close home window
         self.root.destroy()
         
         # load files
         helmet_mesh_file = self.helmet_selection.get()
-        helmet_mesh = pv.read(helmet_mesh_file).triangulate(inplace = True)
+        helmet_mesh = load_template(helmet_mesh_file)
         head_mesh = pv.read(self.stl_file)
         
         # run mesh manipulation window
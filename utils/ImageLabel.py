@@ -6,10 +6,32 @@ Created on Wed Dec 13 15:21:02 2023
 @author: mitchell
 """
 import PIL
-from PIL import ImageTk
-from itertools import count
+from PIL import ImageTk, ImageSequence
 from tkinter import Label
 
+
+def _decode_frames(im):
+    """decode every frame of a PIL image, returns (frames, delay).
+    frames are converted to RGBA up front so building the PhotoImages
+    doesn't have to convert palette frames one at a time"""
+    frames = tuple(frame.convert('RGBA') for frame in ImageSequence.Iterator(im))
+
+    try:
+        delay = im.info['duration']
+    except:
+        delay = 100
+
+    return frames, delay
+
+
+def load_thumbnail(path, factor, master=None):
+    """read an image shrunk by factor and return it as a Tk PhotoImage.
+    shrinking with PIL first means Tk never decodes the full size image"""
+    im = PIL.Image.open(path)
+    im.thumbnail((im.width//factor, im.height//factor), PIL.Image.LANCZOS)
+    return ImageTk.PhotoImage(im, master=master)
+
+
 # developed by user Novel https://stackoverflow.com/questions/43770847/play-an-animated-gif-in-python-with-tkinter
 class ImageLabel(Label):
     """a label that displays images, and plays them if they are gifs"""
@@ -17,19 +39,9 @@ class ImageLabel(Label):
         if isinstance(im, str):
             im = PIL.Image.open(im)
         self.loc = 0
-        self.frames = []
-
-        try:
-            for i in count(1):
-                self.frames.append(ImageTk.PhotoImage(im.copy()))
-                im.seek(i)
-        except EOFError:
-            pass
+        frames, self.delay = _decode_frames(im)
 
-        try:
-            self.delay = im.info['duration']
-        except:
-            self.delay = 100
+        self.frames = tuple(ImageTk.PhotoImage(frame) for frame in frames)
 
         if len(self.frames) == 1:
             self.config(image=self.frames[0])
@@ -45,4 +57,4 @@ class ImageLabel(Label):
             self.loc += 1
             self.loc %= len(self.frames)
             self.config(image=self.frames[self.loc])
-            self.after(self.delay, self.next_frame)
\ No newline at end of file
+            self.after(self.delay, self.next_frame)
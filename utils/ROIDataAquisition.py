@@ -5,10 +5,12 @@ Created on Wed Dec 13 15:01:22 2023
 
 @author: mitchell
 """
+import functools
 import numpy as np
 import SimpleITK as sitk
 from tkinter import *
-import matplotlib.pyplot as plt
+# after the tkinter star import, which has its own Image
+from PIL import Image, ImageTk
 from matplotlib.widgets import RectangleSelector
 import matplotlib.patches as patches
 from matplotlib.figure import Figure
@@ -17,6 +19,8 @@ from matplotlib.ticker import MaxNLocator
 from matplotlib.backends.backend_tkagg import (FigureCanvasTkAgg, 
 NavigationToolbar2Tk)
 from .RegistrationPointDataAquisition import RegistrationPointDataAquisition
+from .displayutils import (window_level_to_uint8, intensity_percentiles, crop_to_roi, IdleRedraw,
+slider_values, window_level_range, DISPLAY_CMAP, DISPLAY_NORM)
 from .sitk2vtk import *
 from .vtkutils import *
 
@@ -59,7 +63,16 @@ class ROIDataAquisition(object):
             self.min_intensity,
             self.max_intensity,
         ) = self.get_window_level_numpy_array(self.image, window_level)
-        self.rois = []
+        # This is the full, uncropped scan, so rather than keeping a uint8 copy of all of it
+        # for display, slices are converted as they are shown and the last few are kept.
+        self.u8_slice = functools.lru_cache(maxsize=16)(self.quantize_slice)
+        # The ROIs are kept column-wise: their patches, their (min_x, max_x, min_y, max_y)
+        # and (min_z, max_z) ranges, and whether each patch is currently shown. The arrays
+        # have spare rows, only the first len(self.roi_patches) are in use.
+        self.roi_patches = []
+        self.roi_xy = np.empty((4, 4), np.int64)
+        self.roi_z = np.empty((4, 2), np.int64)
+        self.roi_visible = np.empty(4, bool)
 
         # ROI display settings
         self.roi_display_properties = dict(
@@ -68,25 +81,30 @@ class ROIDataAquisition(object):
 
         self.create_ui()
 
-        # Create a figure with axes for front, middle, and back 
-        self.back_fig, self.back_ax = plt.subplots(1, 1, figsize=figure_size)
-        self.back_ax.set_title('Back of Head')
+        # The back and front views are only ever paged through with their sliders, so they are
+        # plain Tk canvases showing a PhotoImage rather than matplotlib figures, which would
+        # re-render the whole figure on every slider tick.
+        self.view_size = self.get_view_size(figure_size)
+        # the sliders tend to go back and forth over the same few slices, and the back and
+        # front views can show the same one, so keep the last few scaled slices around
+        self.display_slice = functools.lru_cache(maxsize=8)(self.scale_slice)
+        self.slice_photos = []
+        for i, title in enumerate(['Back of Head', 'Front of Nose']):
+            Label(self.slider_boxes[i], text=title).pack()
+            canvas = Canvas(self.slider_boxes[i], width=self.view_size[0],
+                            height=self.view_size[1], highlightthickness=0)
+            photo = ImageTk.PhotoImage('L', self.view_size, master=self.root)
+            canvas.create_image(0, 0, anchor='nw', image=photo)
+            canvas.pack()
+            self.slider_boxes[i].grid(column = i, row = 1)
+            self.slice_photos.append(photo)
         
-        self.front_fig, self.front_ax = plt.subplots(1, 1, figsize=figure_size)
-        self.front_ax.set_title('Front of Nose')
-        
-        self.middle_fig, self.middle_ax = plt.subplots(1, 1, figsize=figure_size)
+        # The middle view stays in matplotlib for the rectangle selector and the ROI patches.
+        self.middle_fig = Figure(figsize=figure_size)
+        self.middle_ax = self.middle_fig.add_subplot(111)
         self.middle_ax.set_title('Outline head')
-        
-        # only give sliders to the front and back axes, middle axis just gets put in window
-        for i, fig in enumerate([self.back_fig, self.front_fig, self.middle_fig]):
-            if i < 2:
-                canvas = FigureCanvasTkAgg(fig, self.slider_boxes[i])
-                canvas.get_tk_widget().pack()
-                self.slider_boxes[i].grid(column = i, row = 1)
-            else: 
-                canvas = FigureCanvasTkAgg(fig, self.window)
-                canvas.get_tk_widget().grid(column=3, row = 1, padx=20)
+        canvas = FigureCanvasTkAgg(self.middle_fig, self.window)
+        canvas.get_tk_widget().grid(column=3, row = 1, padx=20)
                 
         # Connect the mouse button press to the canvas (__call__ method is the invoked callback).
 
@@ -102,17 +120,16 @@ class ROIDataAquisition(object):
         )
         self.roi_selector.set_visible(False)
 
-        # Display the data and the controls, first time we display the images is outside the "update_display" method
-        # as that method relies on the existance of a previous image which is removed from the figure.
+        # Display the data and the controls. The middle image is only created here, update_display
+        # swaps the displayed slice into it with set_data instead of calling imshow again.
         # .43 gives a slice of the head that is actually near the widest part
         self.middle_slice = round((self.sliders[0].get() + self.sliders[1].get()) * .46)
-        for i, ax in enumerate([self.back_ax, self.front_ax, self.middle_ax]):
-            ax.imshow(
-                self.npa[self.sliders[0].get(), :, :] if i < 2 else self.npa[self.middle_slice, :, :],
-                cmap=plt.cm.Greys_r,
-                vmin=self.min_intensity,
-                vmax=self.max_intensity,
-            )
+        self.middle_im = self.middle_ax.imshow(
+            self.u8_slice(self.middle_slice),
+            cmap=DISPLAY_CMAP,
+            norm=DISPLAY_NORM,
+        )
+        self.middle_ax.set_axis_off()
 
         self.update_display()
 
@@ -150,6 +167,9 @@ class ROIDataAquisition(object):
         # add frames for each image/slider combo to be packed in
         self.slider_boxes = [Frame(self.window), Frame(self.window)]
         self.sliders = [0,0]
+        # slider values last drawn
+        self.shown_slices = (None, None)
+        self.idle_redraw = IdleRedraw(self.root, self.flush_redraw)
         
         # make slider for most posterior
         self.sliders[0] = Scale(
@@ -173,52 +193,74 @@ class ROIDataAquisition(object):
 
         
     def on_slice_slider_value_change(self, change):
-        self.update_display()
+        self.idle_redraw.schedule()
+
+    def flush_redraw(self, pending):
+        # The Scale also calls back without its value changing, only redraw the views whose
+        # slider moved. The middle slice and the ROIs depend on both sliders.
+        current = slider_values(self.sliders)
+        views = {i for i in (0, 1) if current[i] != self.shown_slices[i]}
+        if views:
+            self.update_display(views | {2})
 
     def get_window_level_numpy_array(self, image, window_level):
         npa = sitk.GetArrayViewFromImage(image)
         # We don't take the minimum/maximum values, just in case there are outliers (top/bottom 2%)
         if not window_level:
-            min_max = np.percentile(npa.flatten(), [2, 98])
+            min_max = intensity_percentiles(npa, [2, 98])
             return npa, min_max[0], min_max[1]
         else:
-            return (
-                npa,
-                window_level[1] - window_level[0] / 2.0,
-                window_level[1] + window_level[0] / 2.0,
-            )
+            return (npa,) + window_level_range(window_level)
 
-    def update_display(self):
+    def update_display(self, views=(0, 1, 2)):
         # Draw the image and ROIs.
-        # imshow adds an image to the axes, so we also remove the previous one.
-        # need to do this to front, middle, and back 
+        # need to do this to front, middle, and back, unless only some of them changed.
+        back_slice, front_slice = self.shown_slices = slider_values(self.sliders)
         # 43 gives a slice of the head that is actually near the widest part
-        self.middle_slice = round((self.sliders[0].get() + self.sliders[1].get()) * .46)
-        for i, ax in enumerate([self.back_ax, self.front_ax, self.middle_ax]):
-            ax.imshow(
-                self.npa[self.sliders[i].get(), :, :] if i < 2 else self.npa[self.middle_slice, :, :],
-                cmap=plt.cm.Greys_r,
-                vmin=self.min_intensity,
-                vmax=self.max_intensity,
-            )
-            
-            ax.images[0].remove()
-        
+        self.middle_slice = round((back_slice + front_slice) * .46)
+        for i, z in enumerate((back_slice, front_slice)):
+            if i in views:
+                self.show_slice(i, z)
+        if 2 in views:
+            self.middle_im.set_data(self.u8_slice(self.middle_slice))
 
-        # Iterate over all of the ROIs and only display/undisplay those that are relevant.
-        if self.rois:
-            for roi_data in self.rois:
-                if (
-                    self.sliders[0].get() >= roi_data[3][0]
-                    and self.sliders[1].get() <= roi_data[3][1]
-                ):
-                    roi_data[0].set_visible(True)
-                else:
-                    roi_data[0].set_visible(False)
-        self.middle_ax.set_title(f"selected {len(self.rois)} ROIs")
-        self.middle_ax.set_axis_off()
-        for fig in [self.back_fig, self.front_fig, self.middle_fig]:
-            fig.canvas.draw_idle()
+        # Only display the ROIs that are relevant, and only touch the patches whose
+        # visibility actually changed.
+        n = len(self.roi_patches)
+        if n:
+            visible = (back_slice >= self.roi_z[:n, 0]) & (front_slice <= self.roi_z[:n, 1])
+            for i in np.flatnonzero(visible != self.roi_visible[:n]):
+                self.roi_patches[i].set_visible(visible[i])
+            self.roi_visible[:n] = visible
+        self.middle_ax.set_title(f"selected {n} ROIs")
+        if 2 in views:
+            self.middle_fig.canvas.draw_idle()
+
+    def show_slice(self, view, z):
+        """
+        Paste slice z into the back (0) or front (1) view.
+        """
+        self.slice_photos[view].paste(self.display_slice(z))
+
+    def scale_slice(self, z):
+        """
+        Slice z as a PIL image scaled to the size of the back/front views.
+        """
+        return Image.fromarray(self.u8_slice(z)).resize(self.view_size, Image.BILINEAR)
+
+    def quantize_slice(self, z):
+        """
+        Slice z with the window/level applied, as uint8.
+        """
+        return window_level_to_uint8(self.npa[z, :, :], self.min_intensity, self.max_intensity)
+
+    def get_view_size(self, figure_size, dpi=100):
+        """
+        Size in pixels of a slice scaled to fit in figure_size (inches), keeping its aspect ratio.
+        """
+        height, width = self.npa.shape[1:]
+        scale = min(figure_size[0] * dpi / width, figure_size[1] * dpi / height)
+        return (max(int(round(width * scale)), 1), max(int(round(height * scale)), 1))
 
     def add_roi_data(self, roi_data):
         """
@@ -232,22 +274,35 @@ class ROIDataAquisition(object):
         self.validate_rois(roi_data)
 
         for roi in roi_data:
-            self.rois.append(
-                (
-                    patches.Rectangle(
-                        (roi[0][0], roi[1][0]),
-                        roi[0][1] - roi[0][0],
-                        roi[1][1] - roi[1][0],
-                        **self.roi_display_properties,
-                    ),
-                    roi[0],
-                    roi[1],
-                    roi[2] if self.npa.ndim == 3 else None,
-                )
+            self.store_roi(
+                patches.Rectangle(
+                    (roi[0][0], roi[1][0]),
+                    roi[0][1] - roi[0][0],
+                    roi[1][1] - roi[1][0],
+                    **self.roi_display_properties,
+                ),
+                roi[0],
+                roi[1],
+                roi[2] if self.npa.ndim == 3 else None,
             )
-            self.axes.add_patch(self.rois[-1][0])
         self.update_display()
 
+    def store_roi(self, patch, x_range, y_range, z_range):
+        """
+        Keep a new ROI, its patch is added to the middle axes.
+        """
+        n = len(self.roi_patches)
+        if n == len(self.roi_visible):
+            # out of spare rows, double the storage
+            self.roi_xy = np.concatenate([self.roi_xy, np.empty_like(self.roi_xy)])
+            self.roi_z = np.concatenate([self.roi_z, np.empty_like(self.roi_z)])
+            self.roi_visible = np.concatenate([self.roi_visible, np.empty_like(self.roi_visible)])
+        self.roi_xy[n] = (*x_range, *y_range)
+        self.roi_z[n] = z_range if z_range is not None else (0, self.npa.shape[0] - 1)
+        self.roi_visible[n] = patch.get_visible()
+        self.roi_patches.append(patch)
+        self.middle_ax.add_patch(patch)
+
     def set_rois(self, roi_data):
         """
         Clear any existing ROIs and set the display to the given ones.
@@ -261,23 +316,28 @@ class ROIDataAquisition(object):
         self.add_roi_data(roi_data)
 
     def validate_rois(self, roi_data):
-        for roi in roi_data:
-            for i, bounds in enumerate(roi, 1):
-                if bounds[0] > bounds[1]:
-                    raise ValueError(
-                        "First element in each tuple is expected to be smaller than second element, error in ROI ("
-                        + ", ".join(map(str, roi))
-                        + ")."
-                    )
-                # Note that SimpleITK uses x-y-z specification vs. numpy's z-y-x
-                if not (
-                    bounds[0] >= 0 and bounds[1] < self.npa.shape[self.npa.ndim - i]
-                ):
-                    raise ValueError(
-                        "Given ROI ("
-                        + ", ".join(map(str, roi))
-                        + ") is outside the image bounds."
-                    )
+        roi_data = list(roi_data)
+        if not roi_data:
+            return
+        # bounds[i, j] is the (min, max) pair of dimension j of ROI i
+        bounds = np.asarray(roi_data)
+        mins, maxs = bounds[..., 0], bounds[..., 1]
+        bad_order = np.flatnonzero((mins > maxs).any(axis=1))
+        if len(bad_order):
+            raise ValueError(
+                "First element in each tuple is expected to be smaller than second element, error in ROI ("
+                + ", ".join(map(str, roi_data[bad_order[0]]))
+                + ")."
+            )
+        # Note that SimpleITK uses x-y-z specification vs. numpy's z-y-x
+        size = np.array(self.npa.shape[::-1][: bounds.shape[1]])
+        outside = np.flatnonzero(((mins < 0) | (maxs >= size)).any(axis=1))
+        if len(outside):
+            raise ValueError(
+                "Given ROI ("
+                + ", ".join(map(str, roi_data[outside[0]]))
+                + ") is outside the image bounds."
+            )
 
     def add_roi(self):
         if self.roi_selector.visible:
@@ -285,26 +345,24 @@ class ROIDataAquisition(object):
             # Extent is in sub-pixel coordinates, we need it in pixels/voxels.
             roi_extent = [int(round(coord)) for coord in self.roi_selector.extents]
             # We keep the patch for display and the x,y,z ranges of the ROI.
-            self.rois.append(
-                (
-                    patches.Rectangle(
-                        (roi_extent[0], roi_extent[2]),
-                        roi_extent[1] - roi_extent[0],
-                        roi_extent[3] - roi_extent[2],
-                        **self.roi_display_properties,
-                    ),
-                    (roi_extent[0], roi_extent[1]),
-                    (roi_extent[2], roi_extent[3]),
-                    [i.get() for i in self.sliders],
-                )
+            self.store_roi(
+                patches.Rectangle(
+                    (roi_extent[0], roi_extent[2]),
+                    roi_extent[1] - roi_extent[0],
+                    roi_extent[3] - roi_extent[2],
+                    **self.roi_display_properties,
+                ),
+                (roi_extent[0], roi_extent[1]),
+                (roi_extent[2], roi_extent[3]),
+                [i.get() for i in self.sliders],
             )
-            self.middle_ax.add_patch(self.rois[-1][0])
             self.update_display()
 
     def clear_all_data(self):
-        for roi_data in self.rois:
-            roi_data[0].remove()
-        del self.rois[:]
+        # the rows of the arrays are simply reused
+        for patch in self.roi_patches:
+            patch.remove()
+        del self.roi_patches[:]
 
 # =============================================================================
 #     def clear_all(self):
@@ -313,9 +371,8 @@ class ROIDataAquisition(object):
 # =============================================================================
 
     def clear_last(self):
-        if self.rois:
-            self.rois[-1][0].remove()
-            self.rois.pop()
+        if self.roi_patches:
+            self.roi_patches.pop().remove()
             self.update_display()
 
     def get_rois(self):
@@ -324,12 +381,11 @@ class ROIDataAquisition(object):
         (min_y,max_y), (min_z,max_z) depending on image dimensionality. The ROI is the box defined by these integer values and includes
         both min/max values.
         """
-        return [
-            (roi_data[1], roi_data[2], roi_data[3])
-            if self.npa.ndim == 3
-            else (roi_data[1], roi_data[2])
-            for roi_data in self.rois
-        ]
+        n = len(self.roi_patches)
+        xy = [tuple(map(tuple, roi)) for roi in self.roi_xy[:n].reshape(-1, 2, 2).tolist()]
+        if self.npa.ndim != 3:
+            return xy
+        return [(x, y, tuple(z)) for (x, y), z in zip(xy, self.roi_z[:n].tolist())]
     
 
     def onselect(self, eclick, erelease):
@@ -369,16 +425,26 @@ class ROIDataAquisition(object):
         self.add_roi()
         
         # get rois from gui
-        specified_rois = self.get_rois()
-        print(specified_rois)
+        print(self.get_rois())
         # select the one ROI we will work on
         ROI_INDEX = 0
+        # rows past the stored ROIs are unused storage, don't crop to them
+        if len(self.roi_patches) <= ROI_INDEX:
+            self.show_crop_error("Select an ROI on the middle view before cropping.")
+            return
+        back_slice, front_slice = self.roi_z[ROI_INDEX]
+        if front_slice < back_slice:
+            self.show_crop_error("The front slice is behind the back slice, move the sliders and try again.")
+            return
 
-        # crop
-        roi = specified_rois[ROI_INDEX]
-        self.image = self.image[roi[0][0] : roi[0][1] + 1, 
-                                        roi[1][0] : roi[1][1] + 1, 
-                                        roi[2][0] : roi[2][1] + 1]
+        # crop, (min, max) for x, y and z straight from the ROI arrays
+        cropped = crop_to_roi(
+            self.image, np.concatenate([self.roi_xy[ROI_INDEX], self.roi_z[ROI_INDEX]])
+        )
+        if cropped is None:
+            self.show_crop_error("The ROI is outside the image.")
+            return
+        self.image = cropped
         
         # popup window with button for next step, registration
         # Show a popup message with a continue button
@@ -391,9 +457,25 @@ class ROIDataAquisition(object):
         continue_button = Button(self.popup, text="Continue", command=self.launch_registration_aquisition)
         continue_button.pack()
         
+    def show_crop_error(self, text):
+        """
+        Tell the user why the image wasn't cropped.
+        """
+        popup = Toplevel(self.window)
+        popup.title("Cannot crop")
+        message_label = Label(popup, text=text)
+        message_label.pack(padx=10, pady=10)
+        ok_button = Button(popup, text="OK", command=popup.destroy)
+        ok_button.pack(pady=(0, 10))
+
     def launch_registration_aquisition(self):
         self.popup.destroy()  # Close the popup window
         self.window.pack_forget()
+        # The display array and slices come from the uncropped image, drop them so the full
+        # volume can be freed once registration starts.
+        self.npa = None
+        self.u8_slice.cache_clear()
+        self.display_slice.cache_clear()
 # =============================================================================
 #         self.root.geometry('1000x500')
 # =============================================================================
@@ -6,9 +6,10 @@ Created on Mon Dec 18 14:16:55 2023
 @author: mitchell
 """
 
+import os
+import numpy as np
 import SimpleITK as sitk
 from tkinter import *
-import matplotlib.pyplot as plt
 from matplotlib.figure import Figure
 import matplotlib.cm as cm
 from matplotlib.ticker import MaxNLocator
@@ -16,9 +17,14 @@ from matplotlib.backends.backend_tkagg import (FigureCanvasTkAgg,
 NavigationToolbar2Tk)
 from .visualize_registration import visualize_registration
 from .segment_to_stl import SegmentationScreen
+from .displayutils import (window_level_to_uint8, display_range, IdleRedraw, slider_values,
+slider_range, DISPLAY_CMAP, DISPLAY_NORM)
 from .sitk2vtk import *
 from .vtkutils import *
 
+# let every SimpleITK filter (registration metric, resampling, ...) use all the cores
+sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(os.cpu_count() or 1)
+
 class RegistrationPointDataAquisition(object):
     """
     ***Adapted from SIMPLEITK jupyter notebook tutorials
@@ -50,11 +56,19 @@ class RegistrationPointDataAquisition(object):
             self.fixed_max_intensity,
         ) = self.get_window_level_numpy_array(self.fixed_image, fixed_window_level)
         self.moving_image = moving_image
+        self.moving_window_level = moving_window_level
         (
             self.moving_npa,
             self.moving_min_intensity,
             self.moving_max_intensity,
         ) = self.get_window_level_numpy_array(self.moving_image, moving_window_level)
+        # Apply the window/level once, the displayed slices are taken from these uint8 copies.
+        self.fixed_npa_u8 = window_level_to_uint8(
+            self.fixed_npa, self.fixed_min_intensity, self.fixed_max_intensity
+        )
+        self.moving_npa_u8 = window_level_to_uint8(
+            self.moving_npa, self.moving_min_intensity, self.moving_max_intensity
+        )
         self.fixed_point_indexes = []
         self.moving_point_indexes = []
         self.click_history = (
@@ -67,8 +81,11 @@ class RegistrationPointDataAquisition(object):
       
 
         # Create a figure with two axes for the fixed and moving images.
-        self.fixed_fig, self.fixed_axes = plt.subplots(1, 1, figsize=figure_size)
-        self.moving_fig, self.moving_axes = plt.subplots(1, 1, figsize=figure_size)
+        # (plain Figures rather than pyplot ones, which would be kept open by pyplot)
+        self.fixed_fig = Figure(figsize=figure_size)
+        self.fixed_axes = self.fixed_fig.add_subplot(111)
+        self.moving_fig = Figure(figsize=figure_size)
+        self.moving_axes = self.moving_fig.add_subplot(111)
         
         # put fixed and moving images in their frames
         self.fixed_canvas = FigureCanvasTkAgg(self.fixed_fig, self.fixed_frame)
@@ -82,23 +99,47 @@ class RegistrationPointDataAquisition(object):
 
         self.moving_fig.canvas.mpl_connect("button_press_event", self)
 
-        # Display the data and the controls, first time we display the images is outside the "update_display" method
-        # as that method relies on the previous zoom factor which doesn't exist yet.
-        self.fixed_axes.imshow(
-            self.fixed_npa[self.fixed_slider.get(), :, :]
+        # Display the data and the controls. The images are only created here, update_display
+        # swaps the displayed slice into them with set_data instead of clearing the axes.
+        self.fixed_im = self.fixed_axes.imshow(
+            self.fixed_npa_u8[self.fixed_slider.get(), :, :]
             if self.fixed_slider
-            else self.fixed_npa,
-            cmap=plt.cm.Greys_r,
-            vmin=self.fixed_min_intensity,
-            vmax=self.fixed_max_intensity,
+            else self.fixed_npa_u8,
+            cmap=DISPLAY_CMAP,
+            norm=DISPLAY_NORM,
         )
-        self.moving_axes.imshow(
-            self.moving_npa[self.moving_slider.get(), :, :]
+        self.moving_im = self.moving_axes.imshow(
+            self.moving_npa_u8[self.moving_slider.get(), :, :]
             if self.moving_slider
-            else self.moving_npa,
-            cmap=plt.cm.Greys_r,
-            vmin=self.moving_min_intensity,
-            vmax=self.moving_max_intensity,
+            else self.moving_npa_u8,
+            cmap=DISPLAY_CMAP,
+            norm=DISPLAY_NORM,
+        )
+        # The axes are never cleared, so keep the markers from rescaling them (and resetting
+        # any zoom) as they are added.
+        for axes in [self.fixed_axes, self.moving_axes]:
+            axes.set_autoscale_on(False)
+            axes.set_axis_off()
+        # One marker collection per image whose offsets are replaced on every redraw, and the
+        # point labels, which are moved and reused rather than recreated. These and the titles are
+        # animated: the full figure draw leaves them out, they are blitted on top of a saved copy
+        # of the rest of the figure instead, so adding a point doesn't re-render the image.
+        self.fixed_scatter = self.fixed_axes.scatter(
+            [], [], s=90, marker="+", color=self.text_and_marker_color, animated=True
+        )
+        self.moving_scatter = self.moving_axes.scatter(
+            [], [], s=90, marker="+", color=self.text_and_marker_color, animated=True
+        )
+        self.fixed_point_labels = []
+        self.moving_point_labels = []
+        self.fixed_axes.title.set_animated(True)
+        self.moving_axes.title.set_animated(True)
+        self.backgrounds = {}
+        self.fixed_fig.canvas.mpl_connect(
+            "draw_event", lambda event: self.on_draw(event, 'fixed')
+        )
+        self.moving_fig.canvas.mpl_connect(
+            "draw_event", lambda event: self.on_draw(event, 'moving')
         )
         self.update_display()
 
@@ -121,6 +162,9 @@ class RegistrationPointDataAquisition(object):
         self.fixed_frame.grid(column = 0, row = 2)
         self.moving_frame = Frame(self.window)
         self.moving_frame.grid(column = 3, row = 2)
+        # the slice each view ('fixed', 'moving') last drew
+        self.idle_redraw = IdleRedraw(self.root, self.flush_redraw)
+        self.shown_slices = {'fixed': None, 'moving': None}
         # Sliders are only created if a 3D image, otherwise no need.
         self.fixed_slider = self.moving_slider = None
         if self.fixed_npa.ndim == 3:
@@ -128,19 +172,21 @@ class RegistrationPointDataAquisition(object):
                 self.fixed_frame,
                 from_=0,
                 to=self.fixed_npa.shape[0] - 1,
-                command = self.on_slice_slider_value_change,
+                command = lambda change: self.on_slice_slider_value_change(change, 'fixed'),
             )
             self.fixed_slider.set(274)
             self.fixed_slider.pack()
+            self.fixed_zrange = slider_range(self.fixed_slider)
             
             self.moving_slider = Scale(
                 self.moving_frame,
                 from_=0,
                 to=self.moving_npa.shape[0] - 1,
-                command = self.on_slice_slider_value_change,
+                command = lambda change: self.on_slice_slider_value_change(change, 'moving'),
             )
             self.moving_slider.set(140)
             self.moving_slider.pack()
+            self.moving_zrange = slider_range(self.moving_slider)
         
 
     def get_window_level_numpy_array(self, image, window_level):
@@ -148,121 +194,130 @@ class RegistrationPointDataAquisition(object):
         Get the numpy array representation of the image and the min and max of the intensities
         used for display.
         """
-        npa = sitk.GetArrayViewFromImage(image)
-        if not window_level:
-            return npa, npa.min(), npa.max()
-        else:
-            return (
-                npa,
-                window_level[1] - window_level[0] / 2.0,
-                window_level[1] + window_level[0] / 2.0,
-            )
+        return (sitk.GetArrayViewFromImage(image),) + display_range(image, window_level)
 
-    def on_slice_slider_value_change(self, change):
-        self.update_display()
+    def on_slice_slider_value_change(self, change, view):
+        self.idle_redraw.schedule(view)
 
-    def update_display(self):
+    def flush_redraw(self, pending):
+        # The Scale also calls back without its value changing, skip views already showing
+        # their slider's slice.
+        views = {
+            view for view in pending
+            if self.get_view(view)[3].get() != self.shown_slices[view]
+        }
+        if views:
+            self.update_display(views)
+
+    def update_display(self, views=('fixed', 'moving')):
         """
         Display the two images based on the slider values, if relevant, and the points which are on the
         displayed slices.
         """
-        # We want to keep the zoom factor which was set prior to display, so we log it before
-        # clearing the axes.
-        fixed_xlim = self.fixed_axes.get_xlim()
-        fixed_ylim = self.fixed_axes.get_ylim()
-        moving_xlim = self.moving_axes.get_xlim()
-        moving_ylim = self.moving_axes.get_ylim()
-
-        # Draw the fixed image in the first subplot and the localized points.
-        self.fixed_axes.clear()
-        self.fixed_axes.imshow(
-            self.fixed_npa[self.fixed_slider.get(), :, :]
-            if self.fixed_slider
-            else self.fixed_npa,
-            cmap=plt.cm.Greys_r,
-            vmin=self.fixed_min_intensity,
-            vmax=self.fixed_max_intensity,
-        )
+        # The points are filtered against the same slices.
+        views = tuple(views)
+        self.shown_slices.update(zip(views, slider_values(self.get_view(view)[3] for view in views)))
+        if 'fixed' in views:
+            self.fixed_im.set_data(
+                self.fixed_npa_u8[self.shown_slices['fixed'], :, :]
+                if self.fixed_slider
+                else self.fixed_npa_u8
+            )
+        if 'moving' in views:
+            self.moving_im.set_data(
+                self.moving_npa_u8[self.shown_slices['moving'], :, :]
+                if self.moving_slider
+                else self.moving_npa_u8
+            )
+        # The image changed, so the whole figure is drawn. on_draw then saves the new
+        # background and adds the points.
+        for view in views:
+            self.draw_points(view)
+            self.get_view(view)[0].canvas.draw_idle()
+
+    def update_points(self, views=('fixed', 'moving')):
+        """
+        Redraw only the points and titles, blitting them over the saved backgrounds.
+        """
+        for view in views:
+            self.draw_points(view)
+            canvas = self.get_view(view)[0].canvas
+            if view in self.backgrounds:
+                canvas.restore_region(self.backgrounds[view])
+                self.draw_overlay(view)
+                canvas.blit(canvas.figure.bbox)
+            else:
+                canvas.draw_idle()
+
+    def on_draw(self, event, view):
+        """
+        After a full draw keep a copy of the figure without the points, then draw the points on it.
+        """
+        self.backgrounds[view] = event.canvas.copy_from_bbox(event.canvas.figure.bbox)
+        self.draw_overlay(view)
+
+    def draw_overlay(self, view):
+        fig, axes, point_indexes, slider, scatter, labels = self.get_view(view)
+        axes.draw_artist(scatter)
+        for label in labels:
+            if label.get_visible():
+                axes.draw_artist(label)
+        axes.draw_artist(axes.title)
+
+    def get_view(self, view):
+        """
+        The figure, axes, points, slider, marker collection and point labels of the 'fixed'
+        or 'moving' view.
+        """
+        if view == 'fixed':
+            return (self.fixed_fig, self.fixed_axes, self.fixed_point_indexes,
+                    self.fixed_slider, self.fixed_scatter, self.fixed_point_labels)
+        return (self.moving_fig, self.moving_axes, self.moving_point_indexes,
+                self.moving_slider, self.moving_scatter, self.moving_point_labels)
+
+    def draw_points(self, view):
+        """
+        Mark the points of the view which are on the displayed slice and label them with their
+        index. The markers go into the view's scatter, and its label Text artists are reused
+        for the labels, hiding any that are left over.
+        """
+        fig, axes, point_indexes, slider, scatter, labels = self.get_view(view)
+        axes.set_title(f"{view} image - localized {len(point_indexes)} points")
+
+        # points carry a slice index when the image is 3D, which is when there is a slider
+        pnts = np.asarray(point_indexes, dtype=float).reshape(-1, 3 if slider else 2)
+        if slider:
+            # compare against the slice the view is showing rather than asking the slider again
+            on_slice = np.flatnonzero((pnts[:, 2] + 0.5).astype(int) == self.shown_slices[view])
+        else:
+            on_slice = np.arange(len(pnts))
+        xy = pnts[on_slice, :2]
+        scatter.set_offsets(xy)
+
         # Positioning the text is a bit tricky, we position relative to the data coordinate system, but we
         # want to specify the shift in pixels as we are dealing with display. We therefore (a) get the data
-        # point in the display coordinate system in pixel units (b) modify the point using pixel offset and
-        # transform back to the data coordinate system for display.
+        # points in the display coordinate system in pixel units (b) modify the points using pixel offset and
+        # transform back to the data coordinate system for display. Both transforms are done for all the
+        # points at once.
         text_x_offset = -10
         text_y_offset = -10
-        for i, pnt in enumerate(self.fixed_point_indexes):
-            if (
-                self.fixed_slider and int(pnt[2] + 0.5) == self.fixed_slider.get()
-            ) or not self.fixed_slider:
-                self.fixed_axes.scatter(
-                    pnt[0], pnt[1], s=90, marker="+", color=self.text_and_marker_color
-                )
-                # Get point in pixels.
-                text_in_data_coords = self.fixed_axes.transData.transform(
-                    [pnt[0], pnt[1]]
-                )
-                # Offset in pixels and get in data coordinates.
-                text_in_data_coords = self.fixed_axes.transData.inverted().transform(
-                    (
-                        text_in_data_coords[0] + text_x_offset,
-                        text_in_data_coords[1] + text_y_offset,
-                    )
-                )
-                self.fixed_axes.text(
-                    text_in_data_coords[0],
-                    text_in_data_coords[1],
-                    str(i),
-                    color=self.text_and_marker_color,
-                )
-        self.fixed_axes.set_title(
-            f"fixed image - localized {len(self.fixed_point_indexes)} points"
-        )
-        self.fixed_axes.set_axis_off()
-
-        # Draw the moving image in the second subplot and the localized points.
-        self.moving_axes.clear()
-        self.moving_axes.imshow(
-            self.moving_npa[self.moving_slider.get(), :, :]
-            if self.moving_slider
-            else self.moving_npa,
-            cmap=plt.cm.Greys_r,
-            vmin=self.moving_min_intensity,
-            vmax=self.moving_max_intensity,
-        )
-        for i, pnt in enumerate(self.moving_point_indexes):
-            if (
-                self.moving_slider and int(pnt[2] + 0.5) == self.moving_slider.get()
-            ) or not self.moving_slider:
-                self.moving_axes.scatter(
-                    pnt[0], pnt[1], s=90, marker="+", color=self.text_and_marker_color
-                )
-                text_in_data_coords = self.moving_axes.transData.transform(
-                    [pnt[0], pnt[1]]
-                )
-                text_in_data_coords = self.moving_axes.transData.inverted().transform(
-                    (
-                        text_in_data_coords[0] + text_x_offset,
-                        text_in_data_coords[1] + text_y_offset,
-                    )
-                )
-                self.moving_axes.text(
-                    text_in_data_coords[0],
-                    text_in_data_coords[1],
-                    str(i),
-                    color=self.text_and_marker_color,
+        if len(xy):
+            text_in_data_coords = axes.transData.inverted().transform(
+                axes.transData.transform(xy) + (text_x_offset, text_y_offset)
+            )
+        else:
+            text_in_data_coords = xy
+        for k, (i, (x, y)) in enumerate(zip(on_slice, text_in_data_coords)):
+            if k < len(labels):
+                labels[k].set_position((x, y))
+                labels[k].set_text(str(i))
+                labels[k].set_visible(True)
+            else:
+                labels.append(
+                    axes.text(x, y, str(i), color=self.text_and_marker_color, animated=True)
                 )
-        self.moving_axes.set_title(
-            f"moving image - localized {len(self.moving_point_indexes)} points"
-        )
-        self.moving_axes.set_axis_off()
-
-        # Set the zoom factor back to what it was before we cleared the axes, and rendered our data.
-        self.fixed_axes.set_xlim(fixed_xlim)
-        self.fixed_axes.set_ylim(fixed_ylim)
-        self.moving_axes.set_xlim(moving_xlim)
-        self.moving_axes.set_ylim(moving_ylim)
-
-        self.fixed_fig.canvas.draw_idle()
-        self.moving_fig.canvas.draw_idle()
+        for label in labels[len(on_slice):]:
+            label.set_visible(False)
 
     def clear_all(self):
         """
@@ -271,7 +326,7 @@ class RegistrationPointDataAquisition(object):
         del self.fixed_point_indexes[:]
         del self.moving_point_indexes[:]
         del self.click_history[:]
-        self.update_display()
+        self.update_points()
 
     def clear_last(self):
         """
@@ -282,7 +337,7 @@ class RegistrationPointDataAquisition(object):
             if self.known_transformation:
                 self.click_history.pop().pop()
             self.click_history.pop().pop()
-            self.update_display()
+            self.update_points()
 
     
     
@@ -317,23 +372,50 @@ class RegistrationPointDataAquisition(object):
     
     def get_points(self):
         """
-        Get the points in the image coordinate systems.
+        Get the points in the image coordinate systems, as (N, dimension) arrays of physical points.
         """
         
         if len(self.fixed_point_indexes) != len(self.moving_point_indexes):
             raise Exception(
                 "Number of localized points in fixed and moving images does not match."
             )
-        fixed_point_list = [
-            self.fixed_image.TransformContinuousIndexToPhysicalPoint(pnt)
-            for pnt in self.fixed_point_indexes
-        ]
-        moving_point_list = [
-            self.moving_image.TransformContinuousIndexToPhysicalPoint(pnt)
-            for pnt in self.moving_point_indexes
-        ]
+        fixed_point_list = self.index_to_physical(self.fixed_image, self.fixed_point_indexes)
+        moving_point_list = self.index_to_physical(self.moving_image, self.moving_point_indexes)
         return fixed_point_list, moving_point_list
 
+    def index_to_physical(self, image, point_indexes):
+        """
+        Same as image.TransformContinuousIndexToPhysicalPoint for every point, done as one
+        matrix product: physical = origin + direction * diag(spacing) * index.
+        """
+        dim = image.GetDimension()
+        matrix = np.array(image.GetDirection()).reshape(dim, dim) * np.array(image.GetSpacing())
+        indexes = np.asarray(point_indexes, dtype=float).reshape(-1, dim)
+        return indexes @ matrix.T + np.array(image.GetOrigin())
+
+    def landmark_rigid_transform(self, fixed_points, moving_points):
+        """
+        Least squares rigid transform taking the fixed points onto the moving points, what
+        sitk.LandmarkBasedTransformInitializer computes for a VersorRigid3DTransform, solved
+        directly with an SVD (Kabsch) on the (N, 3) point arrays.
+        Like the initializer, the center of rotation is the fixed points' centroid.
+        """
+        fixed_points = np.asarray(fixed_points, dtype=float)
+        moving_points = np.asarray(moving_points, dtype=float)
+        fixed_center = fixed_points.mean(axis=0)
+        moving_center = moving_points.mean(axis=0)
+        covariance = (fixed_points - fixed_center).T @ (moving_points - moving_center)
+        U, _, Vt = np.linalg.svd(covariance)
+        # flip the last axis if needed so we get a rotation and not a reflection
+        d = np.sign(np.linalg.det(Vt.T @ U.T))
+        rotation = Vt.T @ np.diag([1.0, 1.0, d]) @ U.T
+
+        transform = sitk.VersorRigid3DTransform()
+        transform.SetCenter(fixed_center.tolist())
+        transform.SetMatrix(rotation.ravel().tolist())
+        transform.SetTranslation((moving_center - fixed_center).tolist())
+        return transform
+
     def __call__(self, event):
         """
         Callback invoked when the user clicks inside the figure.
@@ -365,12 +447,9 @@ class RegistrationPointDataAquisition(object):
                     self.click_history.append(self.moving_point_indexes)
                     if self.moving_slider:
                         z_index = int(moving_point_indexes[2] + 0.5)
-                        if (
-                            self.moving_slider.max >= z_index
-                            and self.moving_slider.min <= z_index
-                        ):
+                        if self.moving_zrange[0] <= z_index <= self.moving_zrange[1]:
                             self.moving_slider.set(z_index) 
-                self.update_display()
+                self.update_points()
         if event.inaxes == self.moving_axes:
             if len(self.moving_point_indexes) - len(self.fixed_point_indexes) <= 0:
                 self.moving_point_indexes.append(
@@ -395,12 +474,9 @@ class RegistrationPointDataAquisition(object):
                     self.click_history.append(self.fixed_point_indexes)
                     if self.fixed_slider:
                         z_index = int(fixed_point_indexes[2] + 0.5)
-                        if (
-                            self.fixed_slider.max >= z_index
-                            and self.fixed_slider.min <= z_index
-                        ):
+                        if self.fixed_zrange[0] <= z_index <= self.fixed_zrange[1]:
                             self.fixed_slider.set(z_index)
-                self.update_display()
+                self.update_points()
                 
     def save_points(self):
         """
@@ -410,9 +486,6 @@ class RegistrationPointDataAquisition(object):
         global fixed_image_points, moving_image_points
         # Get the manually specified points and compute the transformation.
         fixed_image_points, moving_image_points = self.get_points()
-        
-        fixed_image_points_flat = [c for p in fixed_image_points for c in p]
-        moving_image_points_flat = [c for p in moving_image_points for c in p]
 
 # =============================================================================
 #         self.init_transform = sitk.AffineTransform(
@@ -422,10 +495,8 @@ class RegistrationPointDataAquisition(object):
 #         )
 # =============================================================================
 
-        # Initialize a Rigid3DTransform using landmark-based initialization
-        self.init_transform = sitk.LandmarkBasedTransformInitializer(sitk.VersorRigid3DTransform(), 
-                                                                fixed_image_points_flat, 
-                                                                moving_image_points_flat)
+        # Initialize a Rigid3DTransform from the landmarks
+        self.init_transform = self.landmark_rigid_transform(fixed_image_points, moving_image_points)
         
 
         print("manual initial transformation is: " + str(self.init_transform.GetParameters()))
@@ -437,19 +508,21 @@ class RegistrationPointDataAquisition(object):
                                                         self.moving_image, 
                                                         self.init_transform)
         
-        minmax_filt = sitk.MinimumMaximumImageFilter()
-        minmax_filt.Execute(self.moving_image)
-        min_voxel = minmax_filt.GetMinimum()
-        
-        # execute the transformation
-        self.moving_resampled = sitk.Resample(
-            self.moving_image,
-            self.fixed_image,
-            self.final_transform,
-            sitk.sitkLinear,
-            min_voxel,
-            self.moving_image.GetPixelID(),
+        # background for the resampled scan, without a window/level the display range
+        # already is the moving image's min and max
+        min_voxel = (
+            float(self.moving_npa.min()) if self.moving_window_level else float(self.moving_min_intensity)
         )
+        
+        # execute the transformation, split over all the cores
+        resampler = sitk.ResampleImageFilter()
+        resampler.SetReferenceImage(self.fixed_image)
+        resampler.SetTransform(self.final_transform)
+        resampler.SetInterpolator(sitk.sitkLinear)
+        resampler.SetDefaultPixelValue(min_voxel)
+        resampler.SetOutputPixelType(self.moving_image.GetPixelID())
+        resampler.SetNumberOfWorkUnits(os.cpu_count() or 1)
+        self.moving_resampled = resampler.Execute(self.moving_image)
 # =============================================================================
 #         # execute the transformation (init only for testing!!!)
 #         self.moving_resampled = sitk.Resample(
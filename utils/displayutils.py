@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Helpers shared by the slice viewers in the ROI and registration GUIs.
+"""
+import numpy as np
+import SimpleITK as sitk
+import matplotlib.cm as cm
+from matplotlib.colors import Normalize
+
+# Every viewer shows uint8 slices from window_level_to_uint8, so they can all share one
+# colormap and normalization instead of each image creating its own.
+DISPLAY_CMAP = cm.Greys_r
+DISPLAY_NORM = Normalize(vmin=0, vmax=255)
+
+# integer images spanning more intensity values than this use np.partition in
+# intensity_percentiles rather than a histogram
+MAX_HISTOGRAM_BINS = 1 << 16
+
+
+def window_level_to_uint8(npa, min_intensity, max_intensity, out=None):
+    """
+    Map an image array onto 0-255 using the display window [min_intensity, max_intensity].
+
+    The viewers display the result with DISPLAY_NORM (0 to 255) so matplotlib doesn't have to
+    normalize a float slice every time the slice changes. The volume is converted one
+    slice at a time through a single float32 scratch slice, so the only full size
+    allocation is the uint8 output.
+
+    Returns
+    -------
+    uint8 numpy array with the same shape as npa (out, if given)
+    """
+    scale = 255.0 / max(max_intensity - min_intensity, np.finfo(np.float32).eps)
+    if out is None:
+        out = np.empty(npa.shape, np.uint8)
+
+    # walk the first axis, 2D images are a single slice
+    slices = npa.reshape((-1,) + npa.shape[-2:]) if npa.ndim > 1 else npa[np.newaxis]
+    out_slices = out.reshape(slices.shape)
+    scratch = np.empty(slices.shape[1:], np.float32)
+    for z in range(slices.shape[0]):
+        np.subtract(slices[z], min_intensity, out=scratch, dtype=np.float32)
+        scratch *= scale
+        scratch += 0.5
+        np.clip(scratch, 0, 255, out=scratch)
+        out_slices[z] = scratch
+    return out
+
+
+def window_level_range(window_level):
+    """
+    The (min, max) intensities shown for window_level, a (window, level) pair. The window is
+    centered on the level, so the range is level -/+ window / 2.
+    """
+    window, level = window_level
+    return level - window / 2.0, level + window / 2.0
+
+
+def display_range(image, window_level=None):
+    """
+    The (min, max) intensities used to display a SimpleITK image: the window_level range if
+    one is given, otherwise the full intensity range of the image. The minimum and maximum
+    come from one multi-threaded pass over the image rather than two over the array.
+    """
+    if window_level:
+        return window_level_range(window_level)
+    minmax_filt = sitk.MinimumMaximumImageFilter()
+    minmax_filt.Execute(image)
+    return minmax_filt.GetMinimum(), minmax_filt.GetMaximum()
+
+
+def intensity_percentiles(npa, percentiles=(2, 98)):
+    """
+    Same values as np.percentile(npa, percentiles) (linear interpolation), without copying
+    and sorting the whole volume.
+
+    Integer images (CT, MR) are counted with np.bincount, one bin per intensity value, and
+    the order statistics are read off the cumulative counts. Other images fall back to
+    np.partition, an O(N) selection.
+
+    Returns
+    -------
+    list of floats, one per percentile
+    """
+    flat = npa.ravel()  # a view for contiguous arrays, unlike flatten
+    positions = [p / 100.0 * (flat.size - 1) for p in percentiles]
+    ranks = sorted({int(np.floor(pos)) for pos in positions} | {int(np.ceil(pos)) for pos in positions})
+
+    order_stats = None
+    if np.issubdtype(flat.dtype, np.integer):
+        lo, hi = int(flat.min()), int(flat.max())
+        if hi - lo < MAX_HISTOGRAM_BINS:
+            offsets = flat.astype(np.intp)
+            offsets -= lo
+            cdf = np.cumsum(np.bincount(offsets, minlength=hi - lo + 1))
+            # the value at rank k is the first one with more than k voxels at or below it
+            order_stats = dict(zip(ranks, (lo + np.searchsorted(cdf, ranks, side="right")).tolist()))
+    if order_stats is None:
+        part = np.partition(flat, ranks)
+        order_stats = {k: part[k] for k in ranks}
+
+    values = []
+    for pos in positions:
+        below, above = float(order_stats[int(np.floor(pos))]), float(order_stats[int(np.ceil(pos))])
+        values.append(below + (pos - np.floor(pos)) * (above - below))
+    return values
+
+
+def crop_to_roi(image, roi):
+    """
+    Crop a SimpleITK image to an ROI given as (min, max) voxel index pairs in x, y, z order,
+    both ends included. The ROI selector can round a corner to one past the last voxel, so
+    the ROI is clamped to the image first, like slicing the image used to.
+
+    Returns
+    -------
+    the cropped image, or None if the ROI is empty
+    """
+    roi = np.asarray(roi, dtype=np.int64).reshape(-1, 2)
+    lower = np.maximum(roi[:, 0], 0)
+    upper = np.minimum(roi[:, 1], np.array(image.GetSize()) - 1)
+    if np.any(upper < lower):
+        return None
+    return sitk.RegionOfInterest(image, (upper - lower + 1).tolist(), lower.tolist())
+
+
+class IdleRedraw(object):
+    """
+    Coalesce slider callbacks into a single redraw. A Scale calls back for every value it
+    passes through while being dragged, and drawing each of those values falls behind the
+    mouse. schedule() collects what needs redrawing and redraw is called once, with
+    everything collected, when Tk is next idle.
+    """
+
+    def __init__(self, widget, redraw):
+        self.widget = widget
+        self.redraw = redraw
+        self.pending = set()
+        self.scheduled = False
+
+    def schedule(self, *keys):
+        self.pending.update(keys)
+        if not self.scheduled:
+            self.scheduled = True
+            self.widget.after_idle(self.flush)
+
+    def flush(self):
+        pending, self.pending = self.pending, set()
+        self.scheduled = False
+        self.redraw(pending)
+
+
+def slider_values(sliders):
+    """
+    Read the current value of each slider, None for a missing slider. Each get() is a round
+    trip to Tcl, so read the sliders once per redraw and keep the values.
+    """
+    return tuple(slider.get() if slider else None for slider in sliders)
+
+
+def slider_range(slider):
+    """
+    The (from, to) range of a Scale as ints. The range is fixed once the Scale is made, so
+    keep the result instead of asking Tcl for it on every click.
+    """
+    return int(slider.cget('from')), int(slider.cget('to'))
@@ -5,8 +5,7 @@ Created on Wed Sep 14 15:53:49 2022
 
 @author: mitchell
 """
-import PIL
-from itertools import count
+from concurrent.futures import ThreadPoolExecutor
 import pyvista as pv
 import numpy as np
 import SimpleITK as sitk
@@ -21,8 +20,12 @@ import matplotlib.cm as cm
 from matplotlib.ticker import MaxNLocator
 from matplotlib.backends.backend_tkagg import (FigureCanvasTkAgg, 
 NavigationToolbar2Tk)
+from .displayutils import (intensity_percentiles, display_range, crop_to_roi, IdleRedraw,
+slider_values, slider_range, window_level_range)
 from .sitk2vtk import *
 from .vtkutils import *
+# ImageLabel lives in its own module, re-exported here for old callers
+from .ImageLabel import ImageLabel
 
 class ROIDataAquisition(object):
     """
@@ -45,6 +48,7 @@ class ROIDataAquisition(object):
             self.max_intensity,
         ) = self.get_window_level_numpy_array(self.image, window_level)
         self.rois = []
+        self.idle_redraw = IdleRedraw(self.window, self.flush_redraw)
 
         # ROI display settings
         self.roi_display_properties = dict(
@@ -86,14 +90,17 @@ class ROIDataAquisition(object):
         # Display the data and the controls, first time we display the images is outside the "update_display" method
         # as that method relies on the existance of a previous image which is removed from the figure.
         # 2.37 gives a slice of the head that is actually near the widest part
+        # update_display only swaps the data of these images.
         self.middle_slice = round(self.sliders[0].get() + self.sliders[1].get() / 2.16)
+        self.slice_images = []
         for i, ax in enumerate([self.back_ax, self.front_ax, self.middle_ax]):
-            ax.imshow(
+            self.slice_images.append(ax.imshow(
                 self.npa[self.sliders[0].get(), :, :] if i < 2 else self.npa[self.middle_slice, :, :],
                 cmap=plt.cm.Greys_r,
                 vmin=self.min_intensity,
                 vmax=self.max_intensity,
-            )
+            ))
+            ax.set_axis_off()
 # =============================================================================
 #         self.axes.imshow(
 #             self.npa[self.slice_slider.get(), :, :] if self.slice_slider else self.npa,
@@ -154,36 +161,29 @@ class ROIDataAquisition(object):
                      )
 
     def on_slice_slider_value_change(self, change):
+        self.idle_redraw.schedule()
+
+    def flush_redraw(self, pending):
         self.update_display()
 
     def get_window_level_numpy_array(self, image, window_level):
         npa = sitk.GetArrayViewFromImage(image)
         # We don't take the minimum/maximum values, just in case there are outliers (top/bottom 2%)
         if not window_level:
-            min_max = np.percentile(npa.flatten(), [2, 98])
+            min_max = intensity_percentiles(npa, [2, 98])
             return npa, min_max[0], min_max[1]
         else:
-            return (
-                npa,
-                window_level[1] - window_level[0] / 2.0,
-                window_level[1] + window_level[0] / 2.0,
-            )
+            return (npa,) + window_level_range(window_level)
 
     def update_display(self):
         # Draw the image and ROIs.
-        # imshow adds an image to the axes, so we also remove the previous one.
+        # The images were created in __init__, just give them the new slices.
         # need to do this to front, middle, and back 
         # 2.16 gives a slice of the head that is actually near the widest part
-        self.middle_slice = round(self.sliders[0].get() + self.sliders[1].get() / 2.16)
-        for i, ax in enumerate([self.back_ax, self.front_ax, self.middle_ax]):
-            ax.imshow(
-                self.npa[self.sliders[i].get(), :, :] if i < 2 else self.npa[self.middle_slice, :, :],
-                cmap=plt.cm.Greys_r,
-                vmin=self.min_intensity,
-                vmax=self.max_intensity,
-            )
-            
-            ax.images[0].remove()
+        back_slice, front_slice = slider_values(self.sliders)
+        self.middle_slice = round(back_slice + front_slice / 2.16)
+        for im, z in zip(self.slice_images, (back_slice, front_slice, self.middle_slice)):
+            im.set_data(self.npa[z, :, :])
         
 # =============================================================================
 #         self.middle_slice = round(self.sliders[0].get() + self.sliders[1].get() / 2)
@@ -209,18 +209,13 @@ class ROIDataAquisition(object):
 #                 print('length of middle images:', len(ax.images))
 # =============================================================================
 
-        # Iterate over all of the ROIs and only display/undisplay those that are relevant.
+        # Only display the ROIs that are relevant, all of them are tested at once.
         if self.rois:
-            for roi_data in self.rois:
-                if (
-                    self.sliders[0].get() >= roi_data[3][0]
-                    and self.sliders[1].get() <= roi_data[3][1]
-                ):
-                    roi_data[0].set_visible(True)
-                else:
-                    roi_data[0].set_visible(False)
+            z_ranges = np.array([roi_data[3] for roi_data in self.rois])
+            visible = (back_slice >= z_ranges[:, 0]) & (front_slice <= z_ranges[:, 1])
+            for roi_data, roi_visible in zip(self.rois, visible.tolist()):
+                roi_data[0].set_visible(roi_visible)
         self.middle_ax.set_title(f"selected {len(self.rois)} ROIs")
-        self.middle_ax.set_axis_off()
         for fig in [self.back_fig, self.front_fig, self.middle_fig]:
             fig.canvas.draw_idle()
 
@@ -348,11 +343,12 @@ class ROIDataAquisition(object):
         # select the one ROI we will work on
         ROI_INDEX = 0
 
-        # crop
-        roi = specified_rois[ROI_INDEX]
-        self.image = self.image[roi[0][0] : roi[0][1] + 1, 
-                                        roi[1][0] : roi[1][1] + 1, 
-                                        roi[2][0] : roi[2][1] + 1]
+        # crop, clamped to the image the same way as the live ROI module
+        cropped = crop_to_roi(self.image, specified_rois[ROI_INDEX])
+        if cropped is None:
+            print("ROI is outside the image, not cropping")
+            return
+        self.image = cropped
         
 class MultiImageDisplay(object):
     """
@@ -397,6 +393,12 @@ class MultiImageDisplay(object):
 
         # Our dynamic slice, based on the axis the user specifies
         self.slc = [slice(None)] * 3
+        self.idle_redraw = IdleRedraw(self.window, self.flush_redraw)
+        # reoriented versions of the last image, by orientation, see reorient
+        self.reoriented_images = {}
+        self.reorient_jobs = {}
+        self.reorient_pool = ThreadPoolExecutor(max_workers=1)
+        self.requested_orientation = None
         self.axis = axis
         
         self.multi_image_frame = Frame(self.window)
@@ -415,69 +417,92 @@ class MultiImageDisplay(object):
             self.axes = [self.axes]
 
         # Display the data and the controls, first time we display the image is outside the "update_display" method
-        # as that method relies on the previous zoom factor which doesn't exist yet.
-        for ax, npa, slider, wl_slider in zip(
-            self.axes, self.npa_list, self.slider_list, self.wl_list
+        # as that method only updates the data and intensity range of these images.
+        self.images = []
+        for ax, npa, title, slider, wl_slider in zip(
+            self.axes, self.npa_list, self.title_list, self.slider_list, self.wl_list
         ):
             self.slc[self.axis] = slice(slider.get(), slider.get() + 1)
             # Need to use squeeze to collapse degenerate dimension (e.g. RGB image size 124 124 1 3)
-            ax.imshow(
+            self.images.append(ax.imshow(
                 np.squeeze(npa[tuple(self.slc)]),
                 cmap=plt.cm.Greys_r,
                 vmin=wl_slider.getValues()[0],
                 vmax=wl_slider.getValues()[1],
-            )
+            ))
+            ax.set_title(title)
+            ax.set_axis_off()
         self.update_display()
         plt.tight_layout()
         
         self.multi_image_frame.pack()
         
     def orient_LPS(self):
-        self.reoriented_image = sitk.DICOMOrient(self.image_list[-1], 'LPS')
-        self.npa_list[-1] = sitk.GetArrayFromImage(self.reoriented_image)
-        self.update_display()
+        self.reorient('LPS')
     
     def orient_RIA(self):
-        self.reoriented_image = sitk.DICOMOrient(self.image_list[-1], 'RIA')
-        self.npa_list[-1] = sitk.GetArrayFromImage(self.reoriented_image)
+        self.reorient('RIA')
+
+    def reorient(self, orientation):
+        """
+        Show the last image in the given orientation. The first time an orientation is
+        asked for, DICOMOrient runs in a worker thread so the window stays responsive, after
+        that the reoriented image is reused.
+        """
+        self.requested_orientation = orientation
+        if orientation in self.reoriented_images:
+            self.show_reoriented(orientation)
+        elif orientation not in self.reorient_jobs:
+            self.reorient_jobs[orientation] = self.reorient_pool.submit(
+                sitk.DICOMOrient, self.image_list[-1], orientation
+            )
+            self.wait_for_reorient(orientation)
+
+    def wait_for_reorient(self, orientation):
+        # Tk widgets can only be touched from the main thread, so poll the job from the
+        # event loop rather than calling back from the worker.
+        job = self.reorient_jobs[orientation]
+        if not job.done():
+            self.multi_image_frame.after(50, self.wait_for_reorient, orientation)
+            return
+        del self.reorient_jobs[orientation]
+        self.reoriented_images[orientation] = job.result()
+        # the user may have picked the other orientation in the meantime
+        if orientation == self.requested_orientation:
+            self.show_reoriented(orientation)
+
+    def show_reoriented(self, orientation):
+        self.reoriented_image = self.reoriented_images[orientation]
+        self.npa_list[-1] = sitk.GetArrayViewFromImage(self.reoriented_image)
         self.update_display()
         
 
     def update_display(self):
 
         # Draw the image(s)
-        for ax, npa, title, slider, wl_slider in zip(
-            self.axes, self.npa_list, self.title_list, self.slider_list, self.wl_list
+        # The axes are not cleared, so the zoom factor set prior to display is kept.
+        for ax, im, npa, slider, wl_slider in zip(
+            self.axes, self.images, self.npa_list, self.slider_list, self.wl_list
         ):
-            # We want to keep the zoom factor which was set prior to display, so we log it before
-            # clearing the axes.
-            xlim = ax.get_xlim()
-            ylim = ax.get_ylim()
-
             self.slc[self.axis] = slice(slider.get(), slider.get() + 1)
-            ax.clear()
             # Need to use squeeze to collapse degenerate dimension (e.g. RGB image size 124 124 1 3)
-            ax.imshow(
-                np.squeeze(npa[tuple(self.slc)]),
-                cmap=plt.cm.Greys_r,
-                vmin=wl_slider.getValues()[0],
-                vmax=wl_slider.getValues()[1],
-            )
-            ax.set_title(title)
-            ax.set_axis_off()
-
-            # Set the zoom factor back to what it was before we cleared the axes, and rendered our data.
-            ax.set_xlim(xlim)
-            ax.set_ylim(ylim)
+            slice_npa = np.squeeze(npa[tuple(self.slc)])
+            if slice_npa.shape[:2] != im.get_array().shape[:2]:
+                # reorienting changed the slice size, fit the image (and the view) to it
+                height, width = slice_npa.shape[:2]
+                im.set_extent((-0.5, width - 0.5, height - 0.5, -0.5))
+                ax.set_xlim(-0.5, width - 0.5)
+                ax.set_ylim(height - 0.5, -0.5)
+            im.set_data(slice_npa)
+            im.set_clim(*wl_slider.getValues())
 
         self.fig.canvas.draw_idle()
     def get_window_level_numpy_array(
         self, image_list, window_level_list, intensity_slider_range_percentile
     ):
-        # Using GetArray and not GetArrayView because we don't keep references
-        # to the original images. If they are deleted outside the view would become
-        # invalid, so we use a copy wich guarentees that the gui is consistent.
-        npa_list = list(map(sitk.GetArrayFromImage, image_list))
+        # Using GetArrayView and not GetArray, the views stay valid because we keep
+        # references to the images (self.image_list and self.reoriented_image).
+        npa_list = list(map(sitk.GetArrayViewFromImage, image_list))
 
         wl_range = []
         wl_init = []
@@ -493,8 +518,8 @@ class MultiImageDisplay(object):
             else:
                 # We don't necessarily take the minimum/maximum values, just in case there are outliers
                 # user can specify how much to take off from top and bottom.
-                min_max = np.percentile(
-                    npa.flatten(), intensity_slider_range_percentile
+                min_max = intensity_percentiles(
+                    npa, intensity_slider_range_percentile
                 )
                 wl_range.append((min_max[0], min_max[1]))
                 if not window_level_list:  # No list was given.
@@ -502,14 +527,17 @@ class MultiImageDisplay(object):
                 else:
                     wl = window_level_list[i]
                     if wl:
-                        wl_init.append((wl[1] - wl[0] / 2.0, wl[1] + wl[0] / 2.0))
+                        wl_init.append(window_level_range(wl))
                     else:  # We have a list, but for this image the entry was left empty: []
                         wl_init.append(wl_range[-1])
         return (npa_list, wl_range, wl_init)
     def on_slice_slider_value_change(self, change):
-        self.update_display()
+        self.idle_redraw.schedule()
 
     def on_wl_slider_value_change(self, change):
+        self.on_slice_slider_value_change(change)
+
+    def flush_redraw(self, pending):
         self.update_display()
     def create_ui(self, wl_range, wl_init):
         # Create the active UI components. 
@@ -683,6 +711,7 @@ class RegistrationPointDataAquisition(object):
                 command = self.on_slice_slider_value_change,
             )
             self.fixed_slider.pack()
+            self.fixed_zrange = slider_range(self.fixed_slider)
             
             self.moving_slider = Scale(
                 self.moving_frame,
@@ -691,6 +720,7 @@ class RegistrationPointDataAquisition(object):
                 command = self.on_slice_slider_value_change,
             )
             self.moving_slider.pack()
+            self.moving_zrange = slider_range(self.moving_slider)
         
 
     def get_window_level_numpy_array(self, image, window_level):
@@ -698,15 +728,7 @@ class RegistrationPointDataAquisition(object):
         Get the numpy array representation of the image and the min and max of the intensities
         used for display.
         """
-        npa = sitk.GetArrayViewFromImage(image)
-        if not window_level:
-            return npa, npa.min(), npa.max()
-        else:
-            return (
-                npa,
-                window_level[1] - window_level[0] / 2.0,
-                window_level[1] + window_level[0] / 2.0,
-            )
+        return (sitk.GetArrayViewFromImage(image),) + display_range(image, window_level)
 
     def on_slice_slider_value_change(self, change):
         self.update_display()
@@ -858,9 +880,7 @@ class RegistrationPointDataAquisition(object):
 
         final_transform, _ = self.multires_registration(fixed_image, moving_image, init_transform)
         
-        minmax_filt = sitk.MinimumMaximumImageFilter()
-        minmax_filt.Execute(moving_image)
-        min_voxel = minmax_filt.GetMinimum()
+        min_voxel = display_range(moving_image)[0]
         
         global moving_resampled 
         
@@ -952,10 +972,7 @@ class RegistrationPointDataAquisition(object):
                     self.click_history.append(self.moving_point_indexes)
                     if self.moving_slider:
                         z_index = int(moving_point_indexes[2] + 0.5)
-                        if (
-                            self.moving_slider.max >= z_index
-                            and self.moving_slider.min <= z_index
-                        ):
+                        if self.moving_zrange[0] <= z_index <= self.moving_zrange[1]:
                             self.moving_slider.set(z_index) 
                 self.update_display()
         if event.inaxes == self.moving_axes:
@@ -982,10 +999,7 @@ class RegistrationPointDataAquisition(object):
                     self.click_history.append(self.fixed_point_indexes)
                     if self.fixed_slider:
                         z_index = int(fixed_point_indexes[2] + 0.5)
-                        if (
-                            self.fixed_slider.max >= z_index
-                            and self.fixed_slider.min <= z_index
-                        ):
+                        if self.fixed_zrange[0] <= z_index <= self.fixed_zrange[1]:
                             self.fixed_slider.set(z_index)
                 self.update_display()
   
@@ -1082,40 +1096,3 @@ def segment_to_stl(img, animal_name):
     bool_mesh = helmet_mesh.boolean_difference(head_mesh)
     plotter2.add_mesh(bool_mesh)
     plotter2.show()
-    
-# developed by user Novel https://stackoverflow.com/questions/43770847/play-an-animated-gif-in-python-with-tkinter
-class ImageLabel(Label):
-    """a label that displays images, and plays them if they are gifs"""
-    def load(self, im):
-        if isinstance(im, str):
-            im = PIL.Image.open(im)
-        self.loc = 0
-        self.frames = []
-
-        try:
-            for i in count(1):
-                self.frames.append(PIL.ImageTk.PhotoImage(im.copy()))
-                im.seek(i)
-        except EOFError:
-            pass
-
-        try:
-            self.delay = im.info['duration']
-        except:
-            self.delay = 100
-
-        if len(self.frames) == 1:
-            self.config(image=self.frames[0])
-        else:
-            self.next_frame()
-
-    def unload(self):
-        self.config(image="")
-        self.frames = None
-
-    def next_frame(self):
-        if self.frames:
-            self.loc += 1
-            self.loc %= len(self.frames)
-            self.config(image=self.frames[self.loc])
-            self.after(self.delay, self.next_frame)
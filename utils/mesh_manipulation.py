@@ -7,6 +7,7 @@ Created on Sat Nov  5 14:22:21 2022
 """
 import os
 from datetime import date
+import numpy as np
 import pyvista as pv
 import tkinter as tk
 from pyvistaqt import BackgroundPlotter
@@ -86,26 +87,22 @@ class MeshManipulationWindow:
         
 
     def expand_mesh_plus(self):
-        # Increase the scaling factor by 0.1
-        self.scaling_factor += 0.01
-        self.scaling_label.config(text=f"{self.scaling_factor:.2f}")
-        # Implement your expansion logic here
-        # Implement your expansion logic here
-        head_mesh.scale([self.scaling_factor,
-                         self.scaling_factor,
-                         self.scaling_factor],
-                        inplace=True)
-        self.update_plotter()
+        # Increase the scaling factor by 0.01
+        self.set_scaling_factor(self.scaling_factor + 0.01)
 
     def expand_mesh_minus(self):
-        # Decrease the scaling factor by 0.1, but ensure it stays positive
-        self.scaling_factor = max(1, self.scaling_factor - 0.01)
+        # Decrease the scaling factor by 0.01, but ensure it stays at least 1
+        self.set_scaling_factor(max(1, self.scaling_factor - 0.01))
+
+    def set_scaling_factor(self, scaling_factor):
+        """
+        Scale the head mesh to scaling_factor times its size when the window opened.
+        scaling_factor is absolute, so only the change from the current factor is applied
+        to the points, in place.
+        """
+        self.head_mesh.points *= scaling_factor / self.scaling_factor
+        self.scaling_factor = scaling_factor
         self.scaling_label.config(text=f"{self.scaling_factor:.2f}")
-        # Implement your expansion logic here
-        head_mesh.scale([self.scaling_factor,
-                         self.scaling_factor,
-                         self.scaling_factor],
-                        inplace=True)
         # update the plot
         self.update_plotter()
 
@@ -180,10 +177,13 @@ def mesh_sub(head_mesh, name='Example', separate = False, PET_restrainer = False
     helmet_mesh = pv.read(mesh_file).triangulate(inplace = True)
     
     
-    # scale up and rotate head mesh
+    # scale up and rotate head mesh, as one matrix so the points are only moved once
     # LR, PA, DV
-    head_mesh.scale([1.20,scaling,scaling], inplace=True)
-    head_mesh.rotate_x(290, inplace=True)
+    c, s = np.cos(np.radians(290)), np.sin(np.radians(290))
+    head_mesh.transform(np.array([[1.20, 0, 0, 0],
+                                  [0, c*scaling, -s*scaling, 0],
+                                  [0, s*scaling, c*scaling, 0],
+                                  [0, 0, 0, 1]]), inplace=True)
     head_mesh = head_mesh.decimate(.5)
     
 # =============================================================================
@@ -194,8 +194,6 @@ def mesh_sub(head_mesh, name='Example', separate = False, PET_restrainer = False
     
     # align the centers of both meshes at 0 then translate 
     helmet_mesh.points -= helmet_mesh.center
-    head_mesh.points -= head_mesh.center
-    head_test = head_mesh.copy()
     # format [LR, PA, DV] or [X, Y, Z]
     # therefor bounds[2] is the back of the head, which we are aligning to the
     # back of the helmet, then nudging it forward a little
@@ -203,7 +201,9 @@ def mesh_sub(head_mesh, name='Example', separate = False, PET_restrainer = False
     PA_offset = 3
     DV_offset = -3.5
     
-    offset = [LR_offset,
+    # centering the head is folded into the offset, it moves the head's bounds
+    # along with it so it only shows up in the LR term
+    offset = [LR_offset - head_mesh.center[0],
               helmet_mesh.bounds[2]-head_mesh.bounds[2]+PA_offset, # 3
               helmet_mesh.bounds[-1]-head_mesh.bounds[-1] + DV_offset] #3.5
     
@@ -6,13 +6,86 @@ Created on Tue Jun 18 12:51:37 2024
 @author: mitchell
 """
 import sys
+import functools
 from datetime import date
+import numpy as np
 import pyvista as pv
 from pyvistaqt import BackgroundPlotter
 from PyQt5 import QtWidgets
 from PyQt5.QtCore import Qt
+import hashlib
 import os
 
+# triangulated copies of the template STLs are kept here between sessions
+TEMPLATE_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'amihgos')
+
+
+def load_template(path):
+    """
+    Read a template STL and triangulate it, caching the result as a .vtp file
+    keyed on the template's path and modification time.
+
+    Returns
+    -------
+    mesh: pyvista PolyData
+    """
+    path = os.path.abspath(path)
+    key = '{}:{}'.format(path, os.path.getmtime(path))
+    cache_path = os.path.join(TEMPLATE_CACHE_DIR,
+                              hashlib.sha1(key.encode()).hexdigest() + '.vtp')
+    
+    if os.path.exists(cache_path):
+        try:
+            return pv.read(cache_path)
+        except Exception:
+            print('could not read cached template, rebuilding:', cache_path)
+    
+    mesh = pv.read(path).triangulate(inplace = True)
+    try:
+        os.makedirs(TEMPLATE_CACHE_DIR, exist_ok=True)
+        mesh.save(cache_path)
+    except OSError:
+        print('could not cache template:', path)
+    return mesh
+
+
+@functools.lru_cache(maxsize=4)
+def _label_text(text):
+    text_mesh = pv.Text3D(text, depth=.9)
+    text_mesh.scale([2.5,2.5,2.5], inplace = True)
+    return text_mesh
+
+
+def label_text(text):
+    """
+    Embossing text for the helmet and chin piece, 2.5x the default Text3D size.
+    The text mesh is only built once per name, callers get their own copy to move.
+    """
+    return _label_text(text).copy()
+
+
+def transform_matrix(rotation=(0, 0, 0), translation=(0, 0, 0), scale=(1, 1, 1)):
+    """
+    4x4 matrix that scales, then translates, then rotates about the x, y and z axes
+    (degrees, about the origin) in that order, the same as chaining mesh.scale,
+    mesh.translate and mesh.rotate_x/y/z. Applying it with mesh.transform moves the points
+    once instead of once per step.
+    """
+    matrix = np.diag([*scale, 1.0])
+    matrix[:3, 3] = translation
+    for axis, angle in enumerate(rotation):
+        if not angle:
+            continue
+        c, s = np.cos(np.radians(angle)), np.sin(np.radians(angle))
+        # rotation within the plane of the two other axes, right handed like vtkTransform
+        i, j = [k for k in range(3) if k != axis]
+        if axis == 1:
+            i, j = j, i
+        rot = np.eye(4)
+        rot[i, i], rot[i, j], rot[j, i], rot[j, j] = c, -s, s, c
+        matrix = rot @ matrix
+    return matrix
+
 
 class ManipulationButton:
     def __init__(self, label, window, layout):
@@ -301,32 +374,36 @@ class MeshManipulationWindow(QtWidgets.QWidget):
 
 
     def update_plotter(self, final_plot=False):
-        # Remove the previous head actor
-        _ = self.plotter.remove_actor(self.head_actor, render=False)
-        
         if final_plot:
             self.plotter.clear()
+            self.head_actor = None
             self.plotter.add_mesh(self.final_mesh)
             if self.chin_subtract_bool:
                 self.plotter.add_mesh(self.chin_bool_mesh)
         else:
             # Gather and apply transformations
             # scaling
-            self.head_mesh = self.og_head_mesh.scale([self.scaling_factor, 1, 1])
+            head_mesh = self.og_head_mesh.scale([self.scaling_factor, 1, 1])
             
             #smoothing 
-            self.head_mesh = self.head_mesh.smooth(n_iter = 20,
-                                                   relaxation_factor = self.smoothing_slider.value()/100.0)
+            head_mesh = head_mesh.smooth(n_iter = 20,
+                                         relaxation_factor = self.smoothing_slider.value()/100.0)
+            
+            # translation then rotation, in one pass over the points
+            head_mesh.transform(transform_matrix(
+                rotation=[self.rotation_button_X.value, 
+                          self.rotation_button_Y.value, 
+                          self.rotation_button_Z.value],
+                translation=[self.LR_translation.value, 
+                             self.PA_translation.value, 
+                             self.DV_translation.value]), inplace=True)
             
-            # translation
-            self.head_mesh.points = self.head_mesh.points + [self.LR_translation.value, 
-                                                             self.PA_translation.value, 
-                                                             self.DV_translation.value]
-            # rotation
-            self.head_mesh.rotate_x(self.rotation_button_X.value, inplace=True)
-            self.head_mesh.rotate_y(self.rotation_button_Y.value, inplace=True)
-            self.head_mesh.rotate_z(self.rotation_button_Z.value, inplace=True)
-            self.head_actor = self.plotter.add_mesh(self.head_mesh, color='magenta')
+            # The head actor draws self.head_mesh, swap the new geometry into it instead of
+            # building a new actor and mapper on every click.
+            self.head_mesh.shallow_copy(head_mesh)
+            if self.head_actor is None:
+                # the final plot cleared the head, put it back
+                self.head_actor = self.plotter.add_mesh(self.head_mesh, color='magenta')
             self.plotter.update()
 
     def close_window(self):
@@ -345,7 +422,7 @@ class MeshManipulationWindow(QtWidgets.QWidget):
         """
         # add chin piece mesh for custom chin piece
         chin_dir = 'templates/SubstractedChinPiece.stl'
-        self.chin_mesh = pv.read(chin_dir).triangulate(inplace = True)
+        self.chin_mesh = load_template(chin_dir)
         
         # Zero the center of chin mesh
         self.chin_mesh.points -= self.chin_mesh.center
@@ -356,8 +433,7 @@ class MeshManipulationWindow(QtWidgets.QWidget):
         self.chin_mesh.translate(chin_offset,inplace =True)
         
         # add text label for chin piece
-        chin_text = pv.Text3D(self.animal_name, depth=.9)
-        chin_text.scale([2.5,2.5,2.5], inplace = True)
+        chin_text = label_text(self.animal_name)
         chin_text.rotate_z(-90, inplace=True)
         chin_text.rotate_x(180, inplace=True)
         chin_text_offset = [28,5,-19.5]
@@ -366,20 +442,21 @@ class MeshManipulationWindow(QtWidgets.QWidget):
         
         
         # Scale up and rotate head mesh
-        head_mesh.scale([scaling, scaling, scaling], inplace=True)
-        head_mesh.rotate_x(270, inplace=True)
+        head_mesh.transform(transform_matrix(rotation=[270, 0, 0],
+                                             scale=[scaling, scaling, scaling]), inplace=True)
         head_mesh = head_mesh.decimate(.5)
     
         # Align the centers of both meshes at 0 then translate 
         helmet_mesh.points -= helmet_mesh.center
-        head_mesh.points -= head_mesh.center
         
         # Format [LR, PA, DV] or [X, Y, Z]
         LR_offset = .7
         PA_offset = -9
         DV_offset = -3.5
         
-        offset = [LR_offset,
+        # Centering the head and then offsetting it is done as one translation. Centering
+        # moves the head's bounds along with it, so it only shows up in the LR term.
+        offset = [LR_offset - head_mesh.center[0],
                   helmet_mesh.bounds[2] - head_mesh.bounds[2] + PA_offset,
                   helmet_mesh.bounds[-1] - head_mesh.bounds[-1] + DV_offset]
     
@@ -387,8 +464,7 @@ class MeshManipulationWindow(QtWidgets.QWidget):
         head_mesh.translate(offset, inplace=True)
         
         # create text object for embossing
-        text = pv.Text3D(self.animal_name, depth=.9)
-        text.scale([2.5,2.5,2.5], inplace = True)
+        text = label_text(self.animal_name)
         text.rotate_z(90, inplace=True)
         if self.helmet_type == 'PET':
             text_offset = [27,5,-11.8] #12.5
@@ -417,7 +493,7 @@ if __name__ == '__main__':
     head_mesh = pv.read(head_file)
     
     helmet_mesh_file = 'templates/Flat_helmet.STL'
-    helmet_mesh = pv.read(helmet_mesh_file).triangulate(inplace = True)
+    helmet_mesh = load_template(helmet_mesh_file)
     
     window = MeshManipulationWindow(helmet_mesh, head_mesh, helmet_type = 'Flat')
     window.run()
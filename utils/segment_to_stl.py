@@ -6,6 +6,7 @@ Created on Mon Dec 18 15:43:53 2023
 @author: mitchell
 """
 import os
+import threading
 # Example usage
 if __name__ == '__main__':
     os.chdir('../')
@@ -17,7 +18,8 @@ import tkinter as tk
 from PyQt5 import QtWidgets
 from utils import sitk2vtk
 from utils import vtkutils
-from utils.mesh_manipulationv2 import MeshManipulationWindow
+from utils.mesh_manipulationv2 import MeshManipulationWindow, load_template
+from utils.ImageLabel import load_thumbnail
 
 class SegmentationScreen:
     def __init__(self, img, animal_name):
@@ -28,8 +30,7 @@ class SegmentationScreen:
         self.root.geometry("300x200")
 
         # Add logo image
-        self.logo = tk.PhotoImage(file='images/logo3.png')
-        self.logo = self.logo.subsample(10,10)
+        self.logo = load_thumbnail('images/logo3.png', 10, master=self.root)
         self.logo_label = tk.Label(master=self.root, image=self.logo)
         self.logo_label.image = self.logo
 
@@ -50,6 +51,30 @@ class SegmentationScreen:
         
     def segment_to_stl(self):
         self.output_dir = 'head_stls/' + self.animal_name + '.stl'
+        # Filtering and meshing take a while, run them in a worker thread. The SimpleITK
+        # filters release the GIL, so the window keeps redrawing while they run, the VTK
+        # meshing steps may still stall it. Tk is only touched from the main thread, which
+        # polls the worker.
+        self.segmentation_error = None
+        self.segmentation = threading.Thread(target=self.run_segmentation, daemon=True)
+        self.segmentation.start()
+        self.root.after(100, self.wait_for_segmentation)
+
+    def run_segmentation(self):
+        try:
+            self.segment_and_mesh()
+        except Exception as e:
+            self.segmentation_error = e
+
+    def wait_for_segmentation(self):
+        if self.segmentation.is_alive():
+            self.root.after(100, self.wait_for_segmentation)
+        elif self.segmentation_error is not None:
+            self.text_label.config(text=f"Segmentation failed: {self.segmentation_error}")
+        else:
+            self.show_helmet_options()
+
+    def segment_and_mesh(self):
         anisotropicSmoothing = True
         thresholds = [-300., -200., 400., 2000.] # this thresholds for skin in HU 
         medianFilter=True
@@ -135,7 +160,8 @@ class SegmentationScreen:
 # =============================================================================
         
         vtkutils.writeMesh(mesh3, self.output_dir)
-        
+
+    def show_helmet_options(self):
         self.done_label = tk.Label(self.root, text="DONE! Select helmet then click below to continue to helmet subtraction.")
         self.done_label.pack(pady=5)
         
@@ -159,7 +185,7 @@ class SegmentationScreen:
     def run_mesh_manipulation_window(self):
         self.root.destroy()
         helmet_mesh_file = self.helmet_selection.get()
-        helmet_mesh = pv.read(helmet_mesh_file).triangulate(inplace = True)
+        helmet_mesh = load_template(helmet_mesh_file)
         head_mesh = pv.read(self.output_dir).triangulate(inplace = True)
         
         # run mesh manipulation window
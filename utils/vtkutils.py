@@ -13,11 +13,24 @@ http://www.apache.org/licenses/LICENSE-2.0
 from __future__ import print_function
 
 # import gc
+import os
 import sys
 import time
 import traceback
 
+import numpy as np
 import vtk
+from vtk.util import numpy_support
+
+# fast-simplification is an optional, much faster quadric decimator.  Fall
+# back to VTK's decimation when it isn't installed.
+try:
+    import fast_simplification
+except ImportError:
+    fast_simplification = None
+
+# NumPy type matching vtkIdType, for building cell connectivity arrays.
+VTK_ID_DTYPE = np.int64 if vtk.vtkIdTypeArray().GetDataTypeSize() == 8 else np.int32
 
 
 #
@@ -44,11 +57,20 @@ def extractSurface(vol, isovalue=0.0):
     """Extract an isosurface from a volume."""
     try:
         t = time.perf_counter()
-        iso = vtk.vtkContourFilter()
-        if vtk.vtkVersion.GetVTKMajorVersion() >= 6:
+        if hasattr(vtk, "vtkFlyingEdges3D"):
+            # flying edges is the faster successor to marching cubes.  The
+            # mesh gets smoothed and decimated afterwards, so skip the extra
+            # gradient pass for normals.
+            iso = vtk.vtkFlyingEdges3D()
             iso.SetInputData(vol)
+            iso.ComputeNormalsOff()
+            iso.ComputeGradientsOff()
         else:
-            iso.SetInput(vol)
+            iso = vtk.vtkContourFilter()
+            if vtk.vtkVersion.GetVTKMajorVersion() >= 6:
+                iso.SetInputData(vol)
+            else:
+                iso.SetInput(vol)
         iso.SetValue(0, isovalue)
         iso.Update()
         print("Surface extracted")
@@ -104,12 +126,14 @@ def cleanMesh(mesh, connectivityFilter=False):
     return None
 
 
-def smoothMesh(mesh, nIterations=10):
-    """Smooth a mesh using VTK's WindowedSincPolyData filter."""
+def smoothMesh(mesh, nIterations=10, passBand=0.1):
+    """Smooth a mesh using VTK's WindowedSincPolyData filter.  All the
+    iterations run inside one filter update."""
     try:
         t = time.perf_counter()
         smooth = vtk.vtkWindowedSincPolyDataFilter()
         smooth.SetNumberOfIterations(nIterations)
+        smooth.SetPassBand(passBand)
         if vtk.vtkVersion.GetVTKMajorVersion() >= 6:
             smooth.SetInputData(mesh)
         else:
@@ -133,21 +157,35 @@ def rotateMesh(mesh, axis=1, angle=0):
     """Rotate a mesh about an arbitrary axis.  Angle is in degrees. """
     try:
         print("Rotating surface: axis=", axis, "angle=", angle)
-        matrix = vtk.vtkTransform()
+        # same rotation vtkTransform's RotateX/RotateY/RotateZ would build
+        theta = np.radians(angle)
+        c, s = np.cos(theta), np.sin(theta)
         if axis == 0:
-            matrix.RotateX(angle)
-        if axis == 1:
-            matrix.RotateY(angle)
-        if axis == 2:
-            matrix.RotateZ(angle)
-        tfilter = vtk.vtkTransformPolyDataFilter()
-        tfilter.SetTransform(matrix)
-        if vtk.vtkVersion.GetVTKMajorVersion() >= 6:
-            tfilter.SetInputData(mesh)
+            matrix = np.array([[1, 0, 0], [0, c, -s], [0, s, c]])
+        elif axis == 1:
+            matrix = np.array([[c, 0, s], [0, 1, 0], [-s, 0, c]])
+        elif axis == 2:
+            matrix = np.array([[c, -s, 0], [s, c, 0], [0, 0, 1]])
         else:
-            tfilter.SetInput(mesh)
-        tfilter.Update()
-        mesh2 = tfilter.GetOutput()
+            matrix = np.identity(3)
+
+        # rotate every point (and normal) with one matrix multiply
+        mesh2 = vtk.vtkPolyData()
+        mesh2.ShallowCopy(mesh)
+        if mesh.GetPoints() is not None:
+            points = numpy_support.vtk_to_numpy(mesh.GetPoints().GetData())
+            vtkpoints = vtk.vtkPoints()
+            vtkpoints.SetData(numpy_support.numpy_to_vtk(
+                (points @ matrix.T).astype(points.dtype), deep=True))
+            mesh2.SetPoints(vtkpoints)
+        for data in (mesh2.GetPointData(), mesh2.GetCellData()):
+            normals = data.GetNormals()
+            if normals is not None:
+                n = numpy_support.vtk_to_numpy(normals)
+                rotated = numpy_support.numpy_to_vtk(
+                    (n @ matrix.T).astype(n.dtype), deep=True)
+                rotated.SetName(normals.GetName())
+                data.SetNormals(rotated)
         return mesh2
     except BaseException:
         print("Surface rotating failed")
@@ -161,22 +199,26 @@ def rotateMesh(mesh, axis=1, angle=0):
 
 
 def reduceMesh(mymesh, reductionFactor):
-    """Reduce the number of triangles in a mesh using VTK's vtkDecimatePro
+    """Reduce the number of triangles in a mesh.  Uses the fast-simplification
+    quadric decimator if it is installed, otherwise VTK's vtkDecimatePro
     filter."""
     try:
         t = time.perf_counter()
-        # deci = vtk.vtkQuadricDecimation()
-        deci = vtk.vtkDecimatePro()
-        deci.SetTargetReduction(reductionFactor)
-        if vtk.vtkVersion.GetVTKMajorVersion() >= 6:
-            deci.SetInputData(mymesh)
+        if fast_simplification is not None:
+            m2 = fastReduceMesh(mymesh, reductionFactor)
         else:
-            deci.SetInput(mymesh)
-        deci.Update()
+            # deci = vtk.vtkQuadricDecimation()
+            deci = vtk.vtkDecimatePro()
+            deci.SetTargetReduction(reductionFactor)
+            if vtk.vtkVersion.GetVTKMajorVersion() >= 6:
+                deci.SetInputData(mymesh)
+            else:
+                deci.SetInput(mymesh)
+            deci.Update()
+            m2 = deci.GetOutput()
+            del deci
+#            deci = None
         print("Surface reduced")
-        m2 = deci.GetOutput()
-        del deci
-#        deci = None
         print("    ", m2.GetNumberOfPolys(), "polygons")
         elapsedTime(t)
         return m2
@@ -188,6 +230,56 @@ def reduceMesh(mymesh, reductionFactor):
     return None
 
 
+def fastReduceMesh(mymesh, reductionFactor):
+    """Reduce a mesh with fast-simplification, working directly on the
+    point and triangle arrays."""
+    points, faces = triangleArrays(mymesh)
+    points, faces = fast_simplification.simplify(points, faces,
+                                                 reductionFactor)
+    return meshFromArrays(points, faces)
+
+
+def triangleArrays(mesh):
+    """Return the (N,3) point array and (M,3) triangle index array of a
+    mesh, triangulating it first if it has strips or non-triangle polygons."""
+    polys = mesh.GetPolys()
+    if (mesh.GetNumberOfStrips() or
+            polys.GetNumberOfConnectivityIds() != 3 * polys.GetNumberOfCells()):
+        tri = vtk.vtkTriangleFilter()
+        tri.SetInputData(mesh)
+        tri.PassVertsOff()
+        tri.PassLinesOff()
+        tri.Update()
+        mesh = tri.GetOutput()
+        polys = mesh.GetPolys()
+
+    points = numpy_support.vtk_to_numpy(mesh.GetPoints().GetData())
+    faces = numpy_support.vtk_to_numpy(
+        polys.GetConnectivityArray()).reshape(-1, 3)
+    return points, faces
+
+
+def meshFromArrays(points, faces):
+    """Build a triangle vtkPolyData from an (N,3) point array and an (M,3)
+    array of point indices."""
+    faces = np.asarray(faces, dtype=VTK_ID_DTYPE)
+    offsets = np.arange(0, faces.size + 1, 3,
+                        dtype=VTK_ID_DTYPE)
+
+    vtkpoints = vtk.vtkPoints()
+    vtkpoints.SetData(numpy_support.numpy_to_vtk(
+        np.ascontiguousarray(points), deep=True))
+    polys = vtk.vtkCellArray()
+    polys.SetData(numpy_support.numpy_to_vtkIdTypeArray(offsets, deep=True),
+                  numpy_support.numpy_to_vtkIdTypeArray(faces.ravel(),
+                                                        deep=True))
+
+    mesh = vtk.vtkPolyData()
+    mesh.SetPoints(vtkpoints)
+    mesh.SetPolys(polys)
+    return mesh
+
+
 # from https://github.com/AOT-AG/DicomToMesh/blob/master/lib/src/meshRoutines.cpp#L109
 # MIT License
 def removeSmallObjects(mesh, ratio):
@@ -208,19 +300,17 @@ def removeSmallObjects(mesh, ratio):
         conn_filter.Update()
 
         # remove objects consisting of less than ratio vertexes of the biggest object
-        region_sizes = conn_filter.GetRegionSizes()
+        n_regions = conn_filter.GetNumberOfExtractedRegions()
+        region_sizes = numpy_support.vtk_to_numpy(
+            conn_filter.GetRegionSizes())[:n_regions]
 
         # find object with most vertices
-        max_size = 0
-        for i in range(conn_filter.GetNumberOfExtractedRegions()):
-            if region_sizes.GetValue(i) > max_size:
-                max_size = region_sizes.GetValue(i)
+        max_size = region_sizes.max() if n_regions else 0
 
         # append regions of sizes over the threshold
         conn_filter.SetExtractionModeToSpecifiedRegions()
-        for i in range(conn_filter.GetNumberOfExtractedRegions()):
-            if region_sizes.GetValue(i) > max_size * ratio:
-                conn_filter.AddSpecifiedRegion(i)
+        for i in np.flatnonzero(region_sizes > max_size * ratio):
+            conn_filter.AddSpecifiedRegion(int(i))
 
         conn_filter.Update()
         processed_mesh = conn_filter.GetOutput()
@@ -272,16 +362,44 @@ def readVTKMesh(name):
     return None
 
 
+# record layout of a binary STL triangle: normal, three vertices and an
+# unused attribute byte count, 50 bytes in all
+STL_DTYPE = np.dtype([("normal", "<f4", (3,)),
+                      ("vertices", "<f4", (3, 3)),
+                      ("attribute", "<u2")])
+STL_HEADER_SIZE = 84
+
+
+def binarySTLCount(name):
+    """Return the triangle count of a binary STL file, or None if the file
+    is ASCII."""
+    with open(name, "rb") as f:
+        header = f.read(STL_HEADER_SIZE)
+    if len(header) < STL_HEADER_SIZE:
+        return None
+    count = int(np.frombuffer(header, dtype="<u4", count=1, offset=80)[0])
+    if os.path.getsize(name) != STL_HEADER_SIZE + count * STL_DTYPE.itemsize:
+        return None
+    return count
+
+
 def readSTL(name):
-    """Read an STL mesh file."""
+    """Read an STL mesh file.  Binary files are parsed in one read with
+    NumPy, ASCII files go through VTK's STL reader."""
     try:
-        reader = vtk.vtkSTLReader()
-        reader.SetFileName(name)
-        reader.Update()
+        count = binarySTLCount(name)
+        if count is None:
+            reader = vtk.vtkSTLReader()
+            reader.SetFileName(name)
+            reader.Update()
+            mesh = reader.GetOutput()
+            del reader
+#            reader = None
+        else:
+            records = np.fromfile(name, dtype=STL_DTYPE, count=count,
+                                  offset=STL_HEADER_SIZE)
+            mesh = meshFromTriangles(records["vertices"])
         print("Input mesh:", name)
-        mesh = reader.GetOutput()
-        del reader
-#        reader = None
         return mesh
     except BaseException:
         print("STL Mesh reader failed")
@@ -291,6 +409,26 @@ def readSTL(name):
     return None
 
 
+def meshFromTriangles(vertices):
+    """Build a vtkPolyData from an (M,3,3) array of triangle corners,
+    merging coincident points the way vtkSTLReader does."""
+    # Adding zero gives a contiguous float32 copy and turns -0.0 into 0.0,
+    # so equal coordinates also have equal bit patterns.
+    corners = vertices.reshape(-1, 3).astype(np.float32) + np.float32(0)
+    bits = corners.view(np.uint32)
+
+    # Sort the corners on their raw bits, start a new point wherever a
+    # corner differs from the previous one, then scatter the point ids back
+    # into triangle order.
+    order = np.lexsort((bits[:, 2], bits[:, 1], bits[:, 0]))
+    sorted_bits = bits[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = np.any(sorted_bits[1:] != sorted_bits[:-1], axis=1)
+    inverse = np.empty(len(order), dtype=VTK_ID_DTYPE)
+    inverse[order] = np.cumsum(first) - 1
+    return meshFromArrays(corners[order[first]], inverse.reshape(-1, 3))
+
+
 def readPLY(name):
     """Read a PLY mesh file."""
     try:
@@ -347,20 +485,25 @@ def writeVTKMesh(mesh, name):
 
 
 def writeSTL(mesh, name):
-    """Write an STL mesh file."""
+    """Write a binary STL mesh file.  The triangle records are built with
+    NumPy and written in a single call."""
     try:
-        writer = vtk.vtkSTLWriter()
-        if vtk.vtkVersion.GetVTKMajorVersion() >= 6:
-            print("writeSTL 1")
-            writer.SetInputData(mesh)
-        else:
-            print("writeSTL 2")
-            writer.SetInput(mesh)
-        writer.SetFileTypeToBinary()
-        writer.SetFileName(name)
-        writer.Write()
+        points, faces = triangleArrays(mesh)
+        triangles = points[faces]
+        normals = np.cross(triangles[:, 1] - triangles[:, 0],
+                           triangles[:, 2] - triangles[:, 0])
+        lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+        normals /= np.where(lengths > 0, lengths, 1)
+
+        records = np.zeros(len(faces), dtype=STL_DTYPE)
+        records["normal"] = normals
+        records["vertices"] = triangles
+
+        with open(name, "wb", buffering=1 << 20) as f:
+            f.write(b"AMIHGOS binary STL".ljust(80, b" "))
+            f.write(np.uint32(len(records)).astype("<u4").tobytes())
+            f.write(records.tobytes())
         print("Output mesh:", name)
-        writer = None
     except BaseException:
         print("STL mesh writer failed")
         exc_type, exc_value, exc_traceback = sys.exc_info()